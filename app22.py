@@ -1,21 +1,182 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import aiohttp
 import asyncio
+import atexit
+import bisect
+import collections
+import hashlib
+import itertools
 import os
-import random
+import re
+import sys
 import time
 import json
+import logging
+import logging.handlers
+import mmap
+import queue
+import struct
+import numpy as np
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from typing import Dict, List
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Set, Union
+
+# Optional faster / binary encoders for client frames
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Logging: LOG_FORMAT "text" (key=value) or "json" lines. Each event type
+# gets at most LOG_RATE_LIMIT lines per LOG_INTERVAL seconds; the rest are
+# counted and reported once per interval. LOG_MODE=summary goes further and
+# reports info events only as per-interval counts.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_MODE = os.getenv("LOG_MODE", "events")
+LOG_INTERVAL = float(os.getenv("LOG_INTERVAL", "10"))
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "50"))
+
+class EventFormatter(logging.Formatter):
+    """One line per event: its name plus structured fields, as text or JSON."""
+
+    def __init__(self, json_lines: bool = False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = (datetime.fromtimestamp(record.created, timezone.utc)
+                     .isoformat(timespec="milliseconds").replace("+00:00", "Z"))
+        fields = getattr(record, "fields", {})
+        if self.json_lines:
+            line = {"ts": timestamp, "level": record.levelname, "event": record.getMessage()}
+            for key, value in fields.items():
+                line[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+            return encode_json(line)
+        parts = [timestamp, record.levelname, record.getMessage()]
+        for key, value in fields.items():
+            value = str(value)
+            parts.append(f"{key}={value!r}" if not value or " " in value or "=" in value
+                         else f"{key}={value}")
+        return " ".join(parts)
+
+class EventLog:
+    """Structured logging that never blocks the event loop on output.
+
+    Calls only put a record on a queue; a QueueListener thread formats and
+    writes it. Rate limiting and summary counts are kept per event name, so
+    a reconnect storm costs a counter increment per event rather than a
+    stdout write.
+    """
+
+    def __init__(self, name: str = "app22"):
+        self.logger = logging.getLogger(name)
+        self.logger.setLevel(LOG_LEVEL)
+        self.logger.propagate = False
+        # Spawned uvicorn workers import this module twice (as __mp_main__
+        # and as app22), so the handler is only installed once per process
+        if not self.logger.handlers:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(EventFormatter(json_lines=LOG_FORMAT == "json"))
+            log_queue = queue.SimpleQueue()
+            self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
+            listener = logging.handlers.QueueListener(log_queue, handler)
+            listener.start()
+            atexit.register(listener.stop)
+        self.summary = LOG_MODE == "summary"
+        self.counts: Dict[str, int] = {}  # event -> occurrences this interval
+        self.suppressed: Dict[str, int] = {}  # event -> occurrences not written this interval
+        self.interval_end = time.monotonic() + LOG_INTERVAL
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.flush()
+
+    def info(self, event: str, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event: str, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def _log(self, level: int, event: str, fields: dict):
+        if not self.logger.isEnabledFor(level):
+            return
+        if time.monotonic() >= self.interval_end:
+            self.flush()
+        count = self.counts.get(event, 0) + 1
+        self.counts[event] = count
+        if count > LOG_RATE_LIMIT or (self.summary and level < logging.WARNING):
+            self.suppressed[event] = self.suppressed.get(event, 0) + 1
+            return
+        self.logger.log(level, event, extra={"fields": fields})
+
+    def flush(self):
+        """End the current interval, reporting what was counted instead of written."""
+        self.interval_end = time.monotonic() + LOG_INTERVAL
+        counts, self.counts = self.counts, {}
+        suppressed, self.suppressed = self.suppressed, {}
+        if self.summary and counts:
+            self.logger.info("log.summary", extra={"fields": dict(interval_s=LOG_INTERVAL, **counts)})
+        elif suppressed:
+            self.logger.warning("log.suppressed", extra={"fields": dict(interval_s=LOG_INTERVAL, **suppressed)})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(max(0.0, self.interval_end - time.monotonic()))
+            if time.monotonic() >= self.interval_end:
+                self.flush()
+
+log = EventLog()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await log.start()
+    await metrics.start()
+    await reaper.start()
+    await bar_engine.start()
+    await quote_cache.start()
+    if recorder is not None:
+        await recorder.start()
+    yield
+    if recorder is not None:
+        await recorder.stop()
+    throttle.stop()
+    await reaper.stop()
+    await quote_cache.stop()
+    await bar_engine.stop()
+    await metrics.stop()
+    # Close the shared upstream connection on shutdown
+    await market_feed.stop()
+    await log.stop()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -31,151 +192,2325 @@ API_KEY = os.getenv("IEX_KEY")
 
 # Check if API key is available
 if not API_KEY:
-    print("WARNING: IEX_KEY environment variable is not set. Running in DEMO MODE with simulated data")
+    log.warning("demo_mode", reason="IEX_KEY is not set; serving simulated data")
     DEMO_MODE = True
 else:
     DEMO_MODE = False
-    FINNHUB_WS_URL = f"wss://ws.finnhub.io?token={API_KEY}"
-    COINAPI_WS_URL = f"wss://ws.coinapi.io/v1/"
+    # FINNHUB_WS_URL can point at a stand-in server (see bench.py)
+    FINNHUB_WS_URL = os.getenv("FINNHUB_WS_URL", f"wss://ws.finnhub.io?token={API_KEY}")
+    COINAPI_WS_URL = os.getenv("COINAPI_WS_URL", "wss://ws.coinapi.io/v1/")
 
-import random
-import time
-from datetime import datetime
+# Optional CoinAPI source for crypto symbols; without a key crypto symbols
+# are requested from Finnhub too. "BTC" maps to COINBASE_SPOT_BTC_USD.
+COINAPI_KEY = os.getenv("COINAPI_KEY")
+COINAPI_EXCHANGE = os.getenv("COINAPI_EXCHANGE", "COINBASE")
+COINAPI_QUOTE = os.getenv("COINAPI_QUOTE", "USD")
+
+# How many recent trades per symbol are remembered to drop prints an
+# upstream resends in a later frame (e.g. after a reconnect); 0 disables it
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "32"))
+
+# Maximum number of frames buffered per client before conflation kicks in
+SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "64"))
+
+# Demo simulator: ticks per second, extra synthetic symbols (SIM0000, ...)
+# that are always simulated, and an optional seed for reproducible prices
+DEMO_TICK_HZ = float(os.getenv("DEMO_TICK_HZ", "1"))
+DEMO_SYMBOLS = int(os.getenv("DEMO_SYMBOLS", "0"))
+DEMO_SEED = int(os.getenv("DEMO_SEED")) if os.getenv("DEMO_SEED") else None
+
+# Multi-process mode: Unix socket on which the feed broker publishes ticks
+# to the uvicorn workers, and how much unsent data a worker may lag behind
+# before the broker starts dropping its ticks
+FEED_SOCKET = os.getenv("FEED_SOCKET")
+DEFAULT_FEED_SOCKET = "/tmp/app22-feed.sock"
+BROKER_MAX_BUFFER = int(os.getenv("BROKER_MAX_BUFFER", str(8 * 1024 * 1024)))
+
+# Tick recorder: directory for the append-only tick logs (off when unset),
+# size at which a new file is started, and how often buffered ticks are written
+RECORD_DIR = os.getenv("RECORD_DIR")
+RECORD_ROTATE_BYTES = int(os.getenv("RECORD_ROTATE_BYTES", str(256 * 1024 * 1024)))
+RECORD_FLUSH_INTERVAL = float(os.getenv("RECORD_FLUSH_INTERVAL", "0.5"))
+
+# Replay mode: a tick log, or a directory of them, replaces the live feed.
+# REPLAY_SPEED is a multiple of real time; 0 replays as fast as possible
+REPLAY_PATH = os.getenv("REPLAY_PATH")
+REPLAY_SPEED = float(os.getenv("REPLAY_SPEED", "1"))
+
+# Multiplexed /ws endpoint: how long ticks are collected into one frame and
+# how many symbols one socket may watch
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "20"))
+MAX_SYMBOLS_PER_CONNECTION = int(os.getenv("MAX_SYMBOLS_PER_CONNECTION", "200"))
+
+# Connection lifecycle: WebSocket protocol ping interval and timeout (dead
+# peers are dropped by uvicorn), how long a client may stay connected
+# without any subscription, how long a single send may stay blocked before
+# the socket is considered dead, and admission limits per process (0 = no limit)
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "20"))
+IDLE_TIMEOUT = float(os.getenv("IDLE_TIMEOUT", "300"))
+SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "30"))
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "10000"))
+MAX_CONNECTIONS_PER_IP = int(os.getenv("MAX_CONNECTIONS_PER_IP", "256"))
+
+# Recent trades kept in memory per symbol, and how many of them a client
+# receives as a snapshot when it subscribes
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "1000"))
+SNAPSHOT_SIZE = int(os.getenv("SNAPSHOT_SIZE", "50"))
+
+# Most symbols one GET /quotes request may ask for, how long (seconds) the
+# upstream subscription a poll takes stays open after the last poll, and
+# how many symbols /quotes may keep subscribed at once
+MAX_QUOTE_SYMBOLS = int(os.getenv("MAX_QUOTE_SYMBOLS", "500"))
+QUOTE_SUBSCRIPTION_TTL = float(os.getenv("QUOTE_SUBSCRIPTION_TTL", "300"))
+MAX_QUOTE_LEASES = int(os.getenv("MAX_QUOTE_LEASES", "1000"))
+
+# OHLCV bar intervals in milliseconds, and closed bars kept per series
+BAR_INTERVALS = {"1s": 1_000, "1m": 60_000, "5m": 300_000}
+BAR_HISTORY = int(os.getenv("BAR_HISTORY", "120"))
+
+# Highest update rate a client may ask for with ?max_hz=
+MAX_UPDATE_HZ = float(os.getenv("MAX_UPDATE_HZ", "50"))
+
+# Per-symbol analytics: EMA periods (in trades) and the time window of the
+# rolling price standard deviation. Session VWAP resets at midnight UTC.
+ANALYTICS_EMA_PERIODS = [int(n) for n in os.getenv("ANALYTICS_EMA_PERIODS", "9,21,50").split(",")
+                         if n.strip()]
+ANALYTICS_WINDOW_MS = int(float(os.getenv("ANALYTICS_WINDOW_S", "60")) * 1000)
+ANALYTICS_FIELDS = ("vwap",) + tuple(f"ema{n}" for n in ANALYTICS_EMA_PERIODS) + ("stddev",)
+EMA_ALPHAS = [2 / (n + 1) for n in ANALYTICS_EMA_PERIODS]
+
+# Symbols as the feeds spell them ("AAPL", "BRK.B", "BINANCE:BTCUSDT"): no
+# "@", which separates a symbol from its stream in channel names, and at
+# most 16 characters, the width of the tick log's symbol field
+SYMBOL_PATTERN = re.compile(r"[A-Z0-9][A-Z0-9.:/_-]{0,15}")
+
+def valid_symbol(symbol: str) -> bool:
+    return SYMBOL_PATTERN.fullmatch(symbol) is not None
+
+def bar_channel(symbol: str, interval: Optional[str] = None) -> str:
+    """Subscription key: the symbol itself for trades, "AAPL@1m" for bars."""
+    return f"{symbol}@{interval}" if interval else symbol
+
+def throttle_channel(symbol: str, max_hz: float) -> str:
+    """Subscription key for trades coalesced to at most max_hz updates: "AAPL@4hz"."""
+    return f"{symbol}@{max_hz:g}hz"
+
+def analytics_channel(symbol: str, fields: tuple) -> str:
+    """Subscription key for analytics: "AAPL@analytics" for every field,
+    "AAPL@analytics:vwap,ema9" for some."""
+    if fields == ANALYTICS_FIELDS:
+        return f"{symbol}@analytics"
+    return f"{symbol}@analytics:{','.join(fields)}"
+
+def analytics_fields(requested: Union[str, List[str], bool, None]) -> Optional[tuple]:
+    """Normalize ?analytics=vwap,ema9 / "analytics": [...] to a tuple of known
+    fields in canonical order; "all" or true selects every field."""
+    if requested is None or requested is False:
+        return None
+    if requested is True or requested == "all":
+        return ANALYTICS_FIELDS
+    if isinstance(requested, str):
+        requested = requested.split(",")
+    if not isinstance(requested, list):
+        raise ValueError("analytics must be a list of fields")
+    wanted = {str(field).strip().lower() for field in requested}
+    unknown = wanted - set(ANALYTICS_FIELDS)
+    if unknown or not wanted:
+        raise ValueError(f"Unknown analytics fields: {', '.join(sorted(unknown)) or '(none)'}; "
+                         f"available: {', '.join(ANALYTICS_FIELDS)}")
+    return tuple(field for field in ANALYTICS_FIELDS if field in wanted)
+
+def stream_channel(symbol: str, bars: Optional[str] = None, max_hz: Optional[float] = None,
+                   analytics: Optional[tuple] = None) -> str:
+    if analytics:
+        return analytics_channel(symbol, analytics)
+    if max_hz:
+        return throttle_channel(symbol, max_hz)
+    return bar_channel(symbol, bars)
+
+def stream_error(bars: Optional[str], max_hz: Optional[float],
+                 analytics: Optional[tuple] = None) -> Optional[str]:
+    """Why a requested bars / max_hz / analytics combination can't be served, if it can't."""
+    if bars is not None and (not isinstance(bars, str) or bars not in BAR_INTERVALS):
+        return f"Unknown bar interval: {bars}"
+    if max_hz is not None:
+        if not 0 < max_hz <= MAX_UPDATE_HZ:
+            return f"max_hz must be between 0 and {MAX_UPDATE_HZ:g}"
+        if bars is not None:
+            return "max_hz applies to trades, not bars"
+    if analytics and (bars is not None or max_hz is not None):
+        return "analytics can't be combined with bars or max_hz"
+    return None
+
+def channel_symbol(channel: str) -> str:
+    return channel.partition("@")[0]
+
+def channel_kind(channel: str) -> str:
+    """What a channel carries, from a fixed set: trade, throttled, bar or analytics."""
+    stream = channel.partition("@")[2]
+    if not stream:
+        return "trade"
+    if stream.startswith("analytics"):
+        return "analytics"
+    return "throttled" if stream.endswith("hz") else "bar"
+
+# Upper bounds, in seconds, of the latency histogram buckets on /metrics
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5)
+
+class Histogram:
+    """Prometheus-style histogram over fixed buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name: str, help_text: str) -> List[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.total}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+def prometheus_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    """Hot-path counters exposed on /metrics in Prometheus text format.
+
+    Everything is preaggregated (plain integer counters and fixed-bucket
+    histograms), so recording a message never allocates; gauges such as
+    subscriber counts and queue depths are read from the live objects only
+    when /metrics is scraped.
+    """
 
-class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.connection_types: Dict[str, str] = {}  # 'stock' or 'crypto'
-
-    async def connect(self, websocket: WebSocket, symbol: str, conn_type: str = 'stock'):
-        await websocket.accept()
-        self.active_connections[symbol] = websocket
-        self.connection_types[symbol] = conn_type
-        print(f"New {conn_type.upper()} WebSocket connection for {symbol}")
-
-    def disconnect(self, symbol: str):
-        if symbol in self.active_connections:
-            conn_type = self.connection_types.get(symbol, 'stock')
-            del self.active_connections[symbol]
-            if symbol in self.connection_types:
-                del self.connection_types[symbol]
-            print(f"{conn_type.upper()} WebSocket connection closed for {symbol}")
-
-    async def send_personal_message(self, message: str, symbol: str):
-        if symbol in self.active_connections:
-            await self.active_connections[symbol].send_text(message)
+        self.inbound: Dict[str, int] = {}  # symbol -> trades received from the feed
+        self.outbound: Dict[tuple, int] = {}  # (symbol, channel kind) -> frames queued to clients
+        self.send_latency = Histogram()
+        self.loop_lag = Histogram()
+        self.task: Optional[asyncio.Task] = None
 
-manager = ConnectionManager()
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._monitor_loop_lag())
 
-# WebSocket endpoint for market data (stocks and crypto)
-@app.websocket("/ws/{symbol}")
-async def websocket_endpoint(websocket: WebSocket, symbol: str, is_crypto: bool = False):
-    symbol = symbol.upper()
-    conn_type = 'crypto' if is_crypto or symbol == 'BTC' else 'stock'
-    print(f"{conn_type.upper()} WebSocket connection requested for symbol: {symbol}")
-    
-    await manager.connect(websocket, symbol, conn_type)
-    print(f"{conn_type.upper()} WebSocket connection accepted for {symbol}")
-    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _monitor_loop_lag(self, interval: float = 0.25):
+        # How late the loop wakes us up is how long other callbacks held it
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + interval
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(0.0, loop.time() - scheduled))
+
+    def render(self) -> str:
+        lines = ["# HELP tracker_inbound_trades_total Trades received from the market feed",
+                 "# TYPE tracker_inbound_trades_total counter"]
+        for symbol, count in self.inbound.items():
+            lines.append(f'tracker_inbound_trades_total{{symbol="{prometheus_label(symbol)}"}} {count}')
+
+        lines += ["# HELP tracker_outbound_frames_total Frames queued to clients",
+                  "# TYPE tracker_outbound_frames_total counter"]
+        for (symbol, kind), count in self.outbound.items():
+            lines.append(f'tracker_outbound_frames_total{{symbol="{prometheus_label(symbol)}",'
+                         f'stream="{kind}"}} {count}')
+
+        lines += ["# HELP tracker_subscribers Clients subscribed to a channel",
+                  "# TYPE tracker_subscribers gauge"]
+        for channel, subscribers in list(manager.subscriptions.items()):
+            lines.append(f'tracker_subscribers{{channel="{prometheus_label(channel)}"}} {len(subscribers)}')
+
+        connections = list(manager.active_connections.values())
+        depths = [len(connection.queue) for connection in connections]
+        dropped = manager.dropped + sum(connection.dropped for connection in connections)
+        merged = manager.merged + sum(connection.merged for connection in connections)
+        lines += [
+            "# HELP tracker_connections Open client connections",
+            "# TYPE tracker_connections gauge",
+            f"tracker_connections {len(connections)}",
+            "# HELP tracker_connections_rejected_total Clients turned away by admission limits",
+            "# TYPE tracker_connections_rejected_total counter",
+            *(f'tracker_connections_rejected_total{{reason="{reason}"}} {count}'
+              for reason, count in manager.rejected.items()),
+            "# HELP tracker_connections_reaped_total Connections closed as dead or idle",
+            "# TYPE tracker_connections_reaped_total counter",
+            *(f'tracker_connections_reaped_total{{reason="{reason}"}} {count}'
+              for reason, count in manager.reaped.items()),
+            "# HELP tracker_send_queue_frames Frames waiting in client send queues",
+            "# TYPE tracker_send_queue_frames gauge",
+            f"tracker_send_queue_frames {sum(depths)}",
+            "# HELP tracker_send_queue_max_frames Deepest client send queue",
+            "# TYPE tracker_send_queue_max_frames gauge",
+            f"tracker_send_queue_max_frames {max(depths, default=0)}",
+            "# HELP tracker_send_queue_dropped_total Frames dropped from full send queues",
+            "# TYPE tracker_send_queue_dropped_total counter",
+            f"tracker_send_queue_dropped_total {dropped}",
+            "# HELP tracker_send_queue_merged_total Frames replaced by a newer one for the same channel",
+            "# TYPE tracker_send_queue_merged_total counter",
+            f"tracker_send_queue_merged_total {merged}",
+            "# HELP tracker_coalesced_trades_total Trades merged into a max_hz update instead of sent alone",
+            "# TYPE tracker_coalesced_trades_total counter",
+            f"tracker_coalesced_trades_total {throttle.coalesced}",
+            "# HELP tracker_upstream_frames_total Frames received from the upstream feed",
+            "# TYPE tracker_upstream_frames_total counter",
+            f"tracker_upstream_frames_total {getattr(market_feed, 'frames_received', 0)}",
+            "# HELP tracker_upstream_reconnects_total Upstream feed reconnections",
+            "# TYPE tracker_upstream_reconnects_total counter",
+            f"tracker_upstream_reconnects_total {getattr(market_feed, 'reconnects', 0)}",
+            "# HELP tracker_recorded_ticks_total Ticks written to the tick log",
+            "# TYPE tracker_recorded_ticks_total counter",
+            f"tracker_recorded_ticks_total {recorder.recorded if recorder is not None else 0}",
+        ]
+        lines += self.send_latency.render("tracker_send_seconds", "Time to write one frame to a client")
+        lines += self.loop_lag.render("tracker_event_loop_lag_seconds", "Event loop scheduling delay")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class Tick:
+    """One normalized trade, whatever feed it came from."""
+
+    __slots__ = ("symbol", "price", "volume", "timestamp")
+
+    def __init__(self, symbol: str, price: float, volume: float, timestamp: int):
+        self.symbol = symbol
+        self.price = price
+        self.volume = volume
+        self.timestamp = timestamp  # ms since the epoch
+
+    def to_dict(self) -> dict:
+        return {"s": self.symbol, "p": self.price, "t": self.timestamp, "v": self.volume}
+
+def split_by_symbol(ticks: List[Tick]) -> Dict[str, List[Tick]]:
+    by_symbol: Dict[str, List[Tick]] = {}
+    for tick in ticks:
+        by_symbol.setdefault(tick.symbol, []).append(tick)
+    return by_symbol
+
+class TickDeduplicator:
+    """Drops trades an upstream sends again in a later frame.
+
+    A trade is a repeat if a recent earlier frame had one with the same
+    time, price and volume. Identical trades within one frame are kept:
+    separate same-size prints in the same millisecond are real trades.
+    """
+
+    def __init__(self, window: int = DEDUP_WINDOW):
+        self.window = window
+        self.recent: Dict[str, collections.deque] = {}
+        self.seen: Dict[str, Set[tuple]] = {}
+        self.duplicates = 0
+
+    def filter(self, symbol: str, ticks: List[Tick]) -> List[Tick]:
+        if not self.window:
+            return ticks
+        recent = self.recent.get(symbol)
+        if recent is None:
+            recent = self.recent[symbol] = collections.deque()
+            self.seen[symbol] = set()
+        seen = self.seen[symbol]
+        # Only earlier frames count, so nothing is remembered until the whole
+        # frame has been checked
+        unique = [tick for tick in ticks if (tick.timestamp, tick.price, tick.volume) not in seen]
+        self.duplicates += len(ticks) - len(unique)
+        for tick in unique:
+            key = (tick.timestamp, tick.price, tick.volume)
+            if key in seen:
+                continue
+            seen.add(key)
+            recent.append(key)
+            if len(recent) > self.window:
+                seen.discard(recent.popleft())
+        return unique
+
+    def forget(self, symbol: str):
+        self.recent.pop(symbol, None)
+        self.seen.pop(symbol, None)
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class FinnhubAdapter:
+    """Finnhub trades protocol (wss://ws.finnhub.io)."""
+
+    name = "Finnhub"
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def connect_messages(self, symbols: Dict[str, str]) -> List[dict]:
+        return [{"type": "subscribe", "symbol": symbol} for symbol in symbols]
+
+    def subscribe_message(self, symbol: str, conn_type: str) -> Optional[dict]:
+        return {"type": "subscribe", "symbol": symbol}
+
+    def unsubscribe_message(self, symbol: str) -> Optional[dict]:
+        return {"type": "unsubscribe", "symbol": symbol}
+
+    def parse(self, message: dict) -> List[Tick]:
+        msg_type = message.get("type")
+        if msg_type == "error":
+            log.warning("upstream.error", feed=self.name, error=message.get("msg"))
+            return []
+        if msg_type != "trade":
+            return []  # Finnhub keepalive pings are not forwarded
+        ticks = []
+        for trade in message.get("data") or []:
+            try:
+                price, volume, timestamp = trade["p"], trade.get("v") or 0, trade["t"]
+                if is_number(price) and is_number(volume) and is_number(timestamp):
+                    ticks.append(Tick(str(trade["s"]), price, volume, int(timestamp)))
+            except (KeyError, TypeError):
+                continue
+        return ticks
+
+def parse_iso_ms(value: str) -> int:
+    """Milliseconds since the epoch from CoinAPI's "2013-09-28T22:40:50.0000000Z"."""
+    head, _, fraction = value.rstrip("Z").partition(".")
+    moment = datetime.strptime(head, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) * 1000 + int((fraction + "000")[:3])
+
+class CoinAPIAdapter:
+    """CoinAPI market data protocol (wss://ws.coinapi.io/v1/) for crypto symbols.
+
+    Client symbols such as "BTC" map to CoinAPI symbol ids like
+    COINBASE_SPOT_BTC_USD. CoinAPI expects a "hello" message before any
+    other, and a hello with no symbol filter subscribes to everything, so
+    nothing is sent until the first symbol is wanted.
+    """
+
+    name = "CoinAPI"
+
+    def __init__(self, url: str, api_key: str, exchange: str = COINAPI_EXCHANGE,
+                 quote: str = COINAPI_QUOTE):
+        self.url = url
+        self.api_key = api_key
+        self.exchange = exchange
+        self.quote = quote
+        self.symbols_by_id: Dict[str, str] = {}
+        self.greeted = False
+
+    def symbol_id(self, symbol: str) -> str:
+        symbol_id = f"{self.exchange}_SPOT_{symbol}_{self.quote}"
+        self.symbols_by_id[symbol_id] = symbol
+        return symbol_id
+
+    def _message(self, msg_type: str, symbols: List[str]) -> dict:
+        return {"type": msg_type, "apikey": self.api_key, "heartbeat": False,
+                "subscribe_data_type": ["trade"],
+                "subscribe_filter_symbol_id": [self.symbol_id(symbol) for symbol in symbols]}
+
+    def connect_messages(self, symbols: Dict[str, str]) -> List[dict]:
+        self.greeted = bool(symbols)
+        return [self._message("hello", list(symbols))] if symbols else []
+
+    def subscribe_message(self, symbol: str, conn_type: str) -> Optional[dict]:
+        msg_type = "subscribe" if self.greeted else "hello"
+        self.greeted = True
+        return self._message(msg_type, [symbol])
+
+    def unsubscribe_message(self, symbol: str) -> Optional[dict]:
+        if not self.greeted:
+            return None
+        return self._message("unsubscribe", [symbol])
+
+    def parse(self, message: dict) -> List[Tick]:
+        msg_type = message.get("type")
+        if msg_type == "error":
+            log.warning("upstream.error", feed=self.name, error=message.get("message"))
+            return []
+        if msg_type != "trade":
+            return []
+        symbol = self.symbols_by_id.get(message.get("symbol_id"))
+        try:
+            price, volume = message["price"], message.get("size") or 0
+            if symbol is None or not (is_number(price) and is_number(volume)):
+                return []
+            return [Tick(symbol, price, volume, parse_iso_ms(message["time_exchange"]))]
+        except (KeyError, TypeError, ValueError):
+            return []
+
+class UpstreamFeed:
+    """Single long-lived upstream WebSocket shared by every client.
+
+    A symbol is subscribed upstream when its first viewer arrives and
+    unsubscribed when the last one leaves (the ConnectionManager tracks who
+    is watching what). Each incoming frame is decoded once by the adapter
+    into Tick records, which are split by symbol, deduplicated and handed to
+    `on_ticks` for recording and fan-out.
+    """
+
+    def __init__(self, adapter: Union["FinnhubAdapter", "CoinAPIAdapter"],
+                 on_ticks: Callable[[str, List[Tick]], None]):
+        self.adapter = adapter
+        self.on_ticks = on_ticks
+        self.dedup = TickDeduplicator()
+        self.symbols: Dict[str, str] = {}  # symbol -> conn_type
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.feed: Optional[aiohttp.ClientWebSocketResponse] = None
+        self.task: Optional[asyncio.Task] = None
+        self.reconnects = 0
+        self.frames_received = 0
+
+    async def start(self):
+        if self.task is None:
+            self.session = aiohttp.ClientSession()
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def subscribe(self, symbol: str, conn_type: str = 'stock'):
+        await self.start()
+        if symbol not in self.symbols:
+            self.symbols[symbol] = conn_type
+            log.info("upstream.subscribe", feed=self.adapter.name, symbol=symbol, conn_type=conn_type)
+            if self._connected():
+                await self._send(self.adapter.subscribe_message(symbol, conn_type))
+
+    async def unsubscribe(self, symbol: str):
+        if symbol in self.symbols:
+            del self.symbols[symbol]
+            self.dedup.forget(symbol)
+            log.info("upstream.unsubscribe", feed=self.adapter.name, symbol=symbol)
+            if self._connected():
+                await self._send(self.adapter.unsubscribe_message(symbol))
+
+    def _connected(self) -> bool:
+        # While disconnected there is nothing to send: every symbol still in
+        # self.symbols is re-subscribed as soon as the feed reconnects.
+        return self.feed is not None and not self.feed.closed
+
+    async def _send(self, message: Optional[dict]):
+        if message is None:
+            return
+        try:
+            await self.feed.send_json(message)
+        except Exception as e:
+            log.error("upstream.send_failed", feed=self.adapter.name, error=str(e))
+
+    async def _run(self):
+        name = self.adapter.name
+        delay = 1
+        while True:
+            try:
+                async with self.session.ws_connect(self.adapter.url, heartbeat=30) as feed:
+                    self.feed = feed
+                    delay = 1
+                    log.info("upstream.connected", feed=name, symbols=len(self.symbols))
+                    for message in self.adapter.connect_messages(dict(self.symbols)):
+                        await feed.send_json(message)
+
+                    async for msg in feed:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.frames_received += 1
+                            self._dispatch(msg.data)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            log.error("upstream.socket_error", feed=name, error=str(feed.exception()))
+                            break
+                    log.warning("upstream.closed", feed=name)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("upstream.connect_failed", feed=name, error=str(e))
+            finally:
+                self.feed = None
+
+            self.reconnects += 1
+            log.info("upstream.reconnecting", feed=name, delay_s=delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+
+    def _dispatch(self, raw: str):
+        try:
+            message = decode_json(raw)
+        except ValueError:
+            log.warning("upstream.invalid_message", feed=self.adapter.name, raw=raw[:200])
+            return
+        if not isinstance(message, dict):
+            return
+        ticks = self.adapter.parse(message)
+        if not ticks:
+            return
+        # Finnhub batches trades for several symbols into one frame
+        for symbol, symbol_ticks in split_by_symbol(ticks).items():
+            symbol_ticks = self.dedup.filter(symbol, symbol_ticks)
+            if symbol_ticks:
+                self.on_ticks(symbol, symbol_ticks)
+
+class FeedRouter:
+    """Sends each symbol to the upstream feed for its asset type."""
+
+    def __init__(self, feeds: Dict[str, UpstreamFeed], default: str = 'stock'):
+        self.feeds = feeds
+        self.default = default
+        self.routes: Dict[str, UpstreamFeed] = {}  # symbol -> feed it was subscribed on
+
+    @property
+    def reconnects(self) -> int:
+        return sum(feed.reconnects for feed in self.feeds.values())
+
+    @property
+    def frames_received(self) -> int:
+        return sum(feed.frames_received for feed in self.feeds.values())
+
+    async def stop(self):
+        for feed in self.feeds.values():
+            await feed.stop()
+
+    async def subscribe(self, symbol: str, conn_type: str = 'stock'):
+        feed = self.feeds.get(conn_type, self.feeds[self.default])
+        self.routes[symbol] = feed
+        await feed.subscribe(symbol, conn_type)
+
+    async def unsubscribe(self, symbol: str):
+        feed = self.routes.pop(symbol, None)
+        if feed is not None:
+            await feed.unsubscribe(symbol)
+
+class DemoSimulator:
+    """Simulated market used in DEMO_MODE, shared by every client.
+
+    One task advances the random walks of all active symbols together: prices
+    live in a single NumPy array and each tick is one vectorized step, so the
+    cost per tick does not grow with the number of viewers and everyone
+    watching a symbol sees the same prices. Ticks are handed to `on_ticks`
+    just like the live feed's.
+    """
+
+    def __init__(self, on_ticks: Callable[[str, List[Tick]], None],
+                 is_watched: Callable[[str], bool], tick_hz: float = DEMO_TICK_HZ,
+                 n_symbols: int = DEMO_SYMBOLS, seed: Optional[int] = DEMO_SEED):
+        self.on_ticks = on_ticks
+        self.is_watched = is_watched  # synthetic symbols nobody watches aren't published
+        self.interval = 1.0 / tick_hz
+        self.rng = np.random.default_rng(seed)
+        self.symbols: List[str] = []
+        self.index: Dict[str, int] = {}  # symbol -> position in the arrays
+        self.prices = np.empty(0)
+        self.is_crypto = np.empty(0, dtype=bool)
+        self.pinned: Set[str] = set()  # synthetic symbols that are never removed
+        self.parked: Dict[str, float] = {}  # last price of removed symbols
+        self.task: Optional[asyncio.Task] = None
+        for i in range(n_symbols):
+            symbol = f"SIM{i:04d}"
+            self._add(symbol, 'stock')
+            self.pinned.add(symbol)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def subscribe(self, symbol: str, conn_type: str = 'stock'):
+        await self.start()
+        if symbol not in self.index:
+            self._add(symbol, conn_type)
+
+    async def unsubscribe(self, symbol: str):
+        if symbol in self.index and symbol not in self.pinned:
+            self._remove(symbol)
+
+    def _add(self, symbol: str, conn_type: str):
+        crypto = conn_type == 'crypto'
+        if symbol in self.parked:
+            base_price = self.parked.pop(symbol)  # resume where the walk left off
+        elif crypto:
+            base_price = self.rng.uniform(30000, 60000)  # Realistic BTC price range
+        else:
+            base_price = self.rng.uniform(100, 200)  # Stock price range
+        self.index[symbol] = len(self.symbols)
+        self.symbols.append(symbol)
+        self.prices = np.append(self.prices, base_price)
+        self.is_crypto = np.append(self.is_crypto, crypto)
+
+    def _remove(self, symbol: str):
+        # Swap the last symbol into the freed slot to keep the arrays dense
+        i = self.index.pop(symbol)
+        self.parked[symbol] = float(self.prices[i])
+        last = len(self.symbols) - 1
+        if i != last:
+            moved = self.symbols[last]
+            self.symbols[i] = moved
+            self.index[moved] = i
+            self.prices[i] = self.prices[last]
+            self.is_crypto[i] = self.is_crypto[last]
+        self.symbols.pop()
+        self.prices = self.prices[:last]
+        self.is_crypto = self.is_crypto[:last]
+
+    def step(self):
+        """Advance every symbol by one tick and publish the new trades."""
+        n = len(self.symbols)
+        if n == 0:
+            return
+        # Ensure price doesn't go below 0.01
+        self.prices = np.maximum(0.01, self.prices + self.rng.uniform(-5, 5, n))
+        volumes = np.where(self.is_crypto,
+                           self.rng.uniform(0.1, 10, n),
+                           self.rng.integers(100, 10001, n))
+        timestamp = int(time.time() * 1000)
+        prices = np.round(self.prices, 2).tolist()
+        volumes = volumes.tolist()
+        crypto = self.is_crypto.tolist()
+        for i, symbol in enumerate(self.symbols):
+            if not self.is_watched(symbol):
+                continue
+            volume = volumes[i] if crypto[i] else int(volumes[i])
+            self.on_ticks(symbol, [Tick(symbol, prices[i], volume, timestamp)])
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                log.error("demo.step_failed", error=str(e))
+            next_tick += self.interval
+            delay = next_tick - loop.time()
+            if delay < 0:
+                next_tick = loop.time()  # fell behind; don't try to catch up
+                delay = 0
+            await asyncio.sleep(delay)
+
+# Tick log files: a TICK_LOG_HEADER (magic, format version, record size)
+# followed by fixed-width little-endian records, one per trade: symbol
+# (16 bytes, NUL padded), price, volume, time ms. Files are only ever
+# appended to; a new one is started once RECORD_ROTATE_BYTES is reached.
+TICK_LOG_MAGIC = b"APP22TCK"
+TICK_LOG_VERSION = 1
+TICK_LOG_HEADER = struct.Struct("<8sII")
+TICK_LOG_RECORD = struct.Struct("<16sddq")
+TICK_LOG_DTYPE = np.dtype([("symbol", "S16"), ("price", "<f8"), ("volume", "<f8"), ("time", "<i8")])
+
+class TickRecorder:
+    """Appends every normalized tick to rotating binary tick logs.
+
+    The hot path only packs ticks into an in-memory buffer; a background
+    task hands the buffer to a thread every RECORD_FLUSH_INTERVAL seconds,
+    so the event loop never waits on the disk.
+    """
+
+    def __init__(self, directory: str, rotate_bytes: int = RECORD_ROTATE_BYTES,
+                 flush_interval: float = RECORD_FLUSH_INTERVAL):
+        self.directory = directory
+        self.rotate_bytes = max(rotate_bytes, TICK_LOG_HEADER.size + TICK_LOG_RECORD.size)
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        self.names: Dict[str, bytes] = {}  # symbol -> encoded symbol field
+        self.file = None
+        self.file_bytes = 0
+        self.sequence = 0
+        self.recorded = 0
+        self.pending: Optional[asyncio.Future] = None  # a write still running in the executor
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # Cancelling the task does not stop a write already handed to a
+        # thread; let it finish so records stay in order and its file closes.
+        if self.pending is not None:
+            try:
+                await self.pending
+            except OSError as e:
+                log.error("recorder.write_failed", error=str(e))
+            self.pending = None
+        data, self.buffer = bytes(self.buffer), bytearray()
+        if data:
+            self._write(data)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, symbol: str, ticks: List[Tick]):
+        name = self.names.get(symbol)
+        if name is None:
+            name = self.names[symbol] = symbol.encode()[:16]
+        pack = TICK_LOG_RECORD.pack
+        for tick in ticks:
+            self.buffer += pack(name, tick.price, tick.volume, tick.timestamp)
+        self.recorded += len(ticks)
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        data, self.buffer = bytes(self.buffer), bytearray()
+        write = self.pending = asyncio.get_running_loop().run_in_executor(None, self._write, data)
+        try:
+            await asyncio.shield(write)
+        except OSError as e:
+            log.error("recorder.write_failed", error=str(e))
+        self.pending = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            if self.file is None or self.file_bytes >= self.rotate_bytes:
+                self._rotate()
+            # Files are only ever cut between records
+            room = self.rotate_bytes - self.file_bytes
+            room = max(room - room % TICK_LOG_RECORD.size, TICK_LOG_RECORD.size)
+            chunk = view[:room]
+            self.file.write(chunk)
+            self.file_bytes += len(chunk)
+            view = view[room:]
+        self.file.flush()
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.sequence += 1
+        name = f"ticks-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.sequence:04d}.bin"
+        path = os.path.join(self.directory, name)
+        self.file = open(path, "xb")
+        self.file.write(TICK_LOG_HEADER.pack(TICK_LOG_MAGIC, TICK_LOG_VERSION, TICK_LOG_RECORD.size))
+        self.file_bytes = TICK_LOG_HEADER.size
+        log.info("recorder.file_opened", path=path)
+
+class ReplayFeed:
+    """Replays recorded tick logs in place of the live feed.
+
+    Each file is memory-mapped and read as a NumPy record array a chunk at a
+    time, so a replay of any length only touches the pages it is streaming.
+    Ticks go through `on_ticks` exactly like live ones, paced by their
+    recorded timestamps at `speed` times real time, or as fast as the
+    server can take them with speed 0. Gaps between files (e.g. between
+    two recording sessions) are skipped.
+    """
+
+    def __init__(self, path: str, on_ticks: Callable[[str, List[Tick]], None],
+                 is_watched: Callable[[str], bool], speed: float = REPLAY_SPEED,
+                 chunk_size: int = 4096):
+        self.path = path
+        self.on_ticks = on_ticks
+        self.is_watched = is_watched  # like the live feed, only watched symbols are published
+        self.speed = max(speed, 0.0)
+        self.chunk_size = chunk_size
+        self.symbols: Dict[str, str] = {}  # symbol -> conn_type
+        self.names: Dict[bytes, str] = {}  # symbol field -> symbol
+        self.origin: Optional[tuple] = None  # (first tick time ms, loop time) of the current file
+        self.position = 0  # recorded time of the last record replayed
+        self.waiting: Optional[int] = None  # recorded time of the record being waited for
+        self.task: Optional[asyncio.Task] = None
+        self.reconnects = 0
+        self.frames_received = 0  # records read from the logs
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def subscribe(self, symbol: str, conn_type: str = 'stock'):
+        await self.start()
+        self.symbols[symbol] = conn_type
+
+    async def unsubscribe(self, symbol: str):
+        self.symbols.pop(symbol, None)
+
+    def clock_ms(self) -> int:
+        """Recorded time the replay has reached, in ms."""
+        if self.waiting is None:
+            return self.position
+        # Between two records recorded time runs at `speed`, up to the next one
+        now = self.origin[0] + (asyncio.get_running_loop().time() - self.origin[1]) * 1000 * self.speed
+        return max(self.position, min(int(now), self.waiting - 1))
+
+    def files(self) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                          if name.endswith(".bin"))
+        return [self.path]
+
+    async def _run(self):
+        started = time.time()
+        try:
+            for path in self.files():
+                log.info("replay.file", path=path)
+                await self._replay_file(path)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("replay.failed", error=str(e))
+            return
+        log.info("replay.finished", ticks=self.frames_received, seconds=round(time.time() - started, 1))
+
+    async def _replay_file(self, path: str):
+        if os.path.getsize(path) < TICK_LOG_HEADER.size:
+            return
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, record_size = TICK_LOG_HEADER.unpack_from(data)
+            if magic != TICK_LOG_MAGIC or record_size != TICK_LOG_DTYPE.itemsize:
+                log.warning("replay.skipped", path=path, reason=f"not a version {TICK_LOG_VERSION} tick log")
+                return
+            count = (len(data) - TICK_LOG_HEADER.size) // record_size
+            records = np.frombuffer(data, dtype=TICK_LOG_DTYPE, count=count,
+                                    offset=TICK_LOG_HEADER.size)
+            self.origin = None
+            try:
+                for start in range(0, count, self.chunk_size):
+                    await self._replay_chunk(records[start:start + self.chunk_size])
+            finally:
+                del records  # the mapping can't close while a view of it exists
+
+    async def _replay_chunk(self, records: np.ndarray):
+        symbols = records["symbol"].tolist()
+        prices = records["price"].tolist()
+        volumes = records["volume"].tolist()
+        times = records["time"].tolist()
+        self.frames_received += len(symbols)
+        loop = asyncio.get_running_loop()
+        batch: List[Tick] = []
+        for i, field in enumerate(symbols):
+            timestamp = times[i]
+            if self.speed:
+                if self.origin is None:
+                    self.origin = (timestamp, loop.time())
+                delay = self.origin[1] + (timestamp - self.origin[0]) / 1000 / self.speed - loop.time()
+                if delay > 0:
+                    self._publish(batch)
+                    batch = []
+                    self.waiting = timestamp
+                    await asyncio.sleep(delay)
+                    self.waiting = None
+            self.position = timestamp
+            symbol = self.names.get(field)
+            if symbol is None:
+                symbol = self.names[field] = field.decode(errors="replace")
+            if batch and batch[-1].symbol != symbol:
+                self._publish(batch)
+                batch = []
+            if self.is_watched(symbol):
+                volume = volumes[i]
+                # Stock volumes were whole numbers before they were recorded
+                batch.append(Tick(symbol, prices[i], int(volume) if volume.is_integer() else volume,
+                                  timestamp))
+        self._publish(batch)
+        await asyncio.sleep(0)  # at full speed, let the client writers run between chunks
+
+    def _publish(self, batch: List[Tick]):
+        if batch:
+            self.on_ticks(batch[0].symbol, batch)
+
+class TickRing:
+    """Fixed-size ring buffer of one symbol's recent trades.
+
+    Prices, volumes and timestamps are stored in separate NumPy columns
+    rather than as dicts, so memory per symbol is fixed and small.
+    """
+
+    def __init__(self, capacity: int = HISTORY_SIZE):
+        self.capacity = capacity
+        self.prices = np.zeros(capacity, dtype=np.float64)
+        self.volumes = np.zeros(capacity, dtype=np.float64)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.head = 0  # next slot to write
+        self.count = 0
+
+    def append(self, price: float, volume: float, timestamp: int):
+        i = self.head
+        self.prices[i] = price
+        self.volumes[i] = volume
+        self.timestamps[i] = timestamp
+        self.head = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def last(self, n: int):
+        """The newest n trades, oldest first, as (prices, volumes, timestamps)."""
+        n = max(0, min(n, self.count))
+        idx = (np.arange(self.head - n, self.head)) % self.capacity
+        return self.prices[idx], self.volumes[idx], self.timestamps[idx]
+
+    def to_trades(self, symbol: str, n: int) -> List[dict]:
+        prices, volumes, timestamps = self.last(n)
+        # Whole volumes go out as ints, like the live trades they were stored from
+        return [{"s": symbol, "p": p, "v": int(v) if v.is_integer() else v, "t": t}
+                for p, v, t in zip(prices.tolist(), volumes.tolist(), timestamps.tolist())]
+
+class QuoteCache:
+    """Last trade per symbol, kept current by the feed path for GET /quotes.
+
+    Polling a symbol leases an upstream subscription for it, held like one
+    more subscriber until it goes `ttl` seconds without a poll, so /quotes
+    works whether or not a WebSocket client watches the symbol. The ETag of
+    a set of symbols hashes their last trades, so every worker gives the
+    same quotes the same ETag.
+    """
+
+    def __init__(self, ttl: float = QUOTE_SUBSCRIPTION_TTL, max_leases: int = MAX_QUOTE_LEASES,
+                 interval: float = 1.0):
+        self.last: Dict[str, Tick] = {}
+        self.ttl = ttl
+        self.max_leases = max_leases
+        self.interval = interval
+        self.leases: Dict[str, float] = {}  # symbol -> monotonic time its lease runs out
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def update(self, symbol: str, tick: Tick):
+        self.last[symbol] = tick
+
+    def forget(self, symbol: str):
+        self.last.pop(symbol, None)
+
+    def lease(self, symbols: List[str]) -> Optional[List[str]]:
+        """Renew the lease on every symbol; returns the ones that had none, or
+        None (leasing nothing) if they would take more than max_leases."""
+        expires = time.monotonic() + self.ttl
+        new = [symbol for symbol in symbols if symbol not in self.leases]
+        if len(self.leases) + len(new) > self.max_leases:
+            return None
+        for symbol in symbols:
+            self.leases[symbol] = expires
+        return new
+
+    def expired(self, now: float) -> List[str]:
+        """Drop and return the symbols whose lease has run out."""
+        lapsed = [symbol for symbol, expires in self.leases.items() if expires <= now]
+        for symbol in lapsed:
+            del self.leases[symbol]
+        return lapsed
+
+    def etag(self, symbols: List[str]) -> str:
+        parts = []
+        for symbol in symbols:
+            tick = self.last.get(symbol)
+            parts.append(f"{symbol}:-" if tick is None
+                         else f"{symbol}:{tick.price}:{tick.volume}:{tick.timestamp}")
+        return '"' + hashlib.blake2b(",".join(parts).encode(), digest_size=8).hexdigest() + '"'
+
+    def quotes(self, symbols: List[str]) -> dict:
+        found = [self.last[symbol].to_dict() for symbol in symbols if symbol in self.last]
+        missing = [symbol for symbol in symbols if symbol not in self.last]
+        return {"data": found, "missing": missing}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for symbol in self.expired(time.monotonic()):
+                try:
+                    await release_symbol(symbol)
+                except Exception as e:
+                    log.error("quotes.release_failed", symbol=symbol, error=str(e))
+
+def create_upstream_feed(on_ticks: Callable[[str, List[Tick]], None],
+                         is_watched: Callable[[str], bool]):
+    """The feed that talks to the outside world for this configuration."""
+    if REPLAY_PATH:
+        return ReplayFeed(REPLAY_PATH, on_ticks, is_watched)
     if DEMO_MODE:
-        print(f"Running in DEMO MODE for {symbol} ({conn_type})")
+        return DemoSimulator(on_ticks, is_watched)
+    finnhub = UpstreamFeed(FinnhubAdapter(FINNHUB_WS_URL), on_ticks)
+    if not COINAPI_KEY:
+        return finnhub
+    coinapi = UpstreamFeed(CoinAPIAdapter(COINAPI_WS_URL, COINAPI_KEY), on_ticks)
+    return FeedRouter({'stock': finnhub, 'crypto': coinapi})
+
+class FeedBroker:
+    """Owns the upstream feed in multi-process mode and shares it with workers.
+
+    Each uvicorn worker connects over a Unix domain socket and exchanges
+    newline-delimited JSON with the broker: the worker sends
+    {"type": "subscribe"|"unsubscribe", "symbol": ..., "conn_type": ...}
+    and receives {"s": symbol, "data": [[price, volume, time], ...]} lines
+    for the symbols it asked for. Upstream subscriptions are reference
+    counted across workers, so there is still one per symbol however many
+    workers there are. With RECORD_DIR set, the broker is the one recording.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}  # symbol -> workers
+        self.dropped = 0
+        self.feed = create_upstream_feed(self.publish, self.subscribers.__contains__)
+        self.recorder = TickRecorder(RECORD_DIR) if RECORD_DIR and not REPLAY_PATH else None
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle_worker, path=self.path)
+        log.info("broker.listening", path=self.path)
+        await log.start()
+        if self.recorder is not None:
+            await self.recorder.start()
         try:
-            if conn_type == 'crypto':
-                base_price = random.uniform(30000, 60000)  # Realistic BTC price range
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.feed.stop()
+            if self.recorder is not None:
+                await self.recorder.stop()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            await log.stop()
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        symbols: Set[str] = set()
+        log.info("broker.worker_connected")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    msg_type = request.get("type")
+                    symbol = str(request["symbol"]).upper()
+                except (ValueError, KeyError, AttributeError):
+                    log.warning("broker.invalid_request", raw=repr(line[:200]))
+                    continue
+
+                if msg_type == "subscribe" and symbol not in symbols:
+                    symbols.add(symbol)
+                    workers = self.subscribers.setdefault(symbol, set())
+                    workers.add(writer)
+                    if len(workers) == 1:
+                        await self.feed.subscribe(symbol, request.get("conn_type", 'stock'))
+                elif msg_type == "unsubscribe" and symbol in symbols:
+                    symbols.discard(symbol)
+                    await self._release(symbol, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            log.error("broker.worker_lost", error=str(e))
+        finally:
+            for symbol in symbols:
+                await self._release(symbol, writer)
+            writer.close()
+            log.info("broker.worker_disconnected", symbols=len(symbols))
+
+    async def _release(self, symbol: str, writer: asyncio.StreamWriter):
+        workers = self.subscribers.get(symbol)
+        if workers is None:
+            return
+        workers.discard(writer)
+        if not workers:
+            del self.subscribers[symbol]
+            await self.feed.unsubscribe(symbol)
+
+    def publish(self, symbol: str, ticks: List[Tick]):
+        if self.recorder is not None:
+            self.recorder.record(symbol, ticks)
+        workers = self.subscribers.get(symbol)
+        if not workers:
+            return
+        data = [[tick.price, tick.volume, tick.timestamp] for tick in ticks]
+        line = (encode_json({"s": symbol, "data": data}) + "\n").encode()
+        for writer in workers:
+            # A worker that stopped reading loses ticks instead of growing our memory
+            if writer.transport.get_write_buffer_size() > BROKER_MAX_BUFFER:
+                self.dropped += 1
+                continue
+            writer.write(line)
+
+class BrokerFeed:
+    """Worker-side feed in multi-process mode: ticks come from the FeedBroker.
+
+    Same interface as UpstreamFeed and DemoSimulator, so the client path does
+    not know whether it runs in a single process or behind a broker.
+    """
+
+    def __init__(self, path: str, on_ticks: Callable[[str, List[Tick]], None]):
+        self.path = path
+        self.on_ticks = on_ticks
+        self.symbols: Dict[str, str] = {}  # symbol -> conn_type
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+        self.reconnects = 0
+        self.frames_received = 0
+        self.position = 0  # latest trade time received
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def subscribe(self, symbol: str, conn_type: str = 'stock'):
+        await self.start()
+        if symbol not in self.symbols:
+            self.symbols[symbol] = conn_type
+            self._send({"type": "subscribe", "symbol": symbol, "conn_type": conn_type})
+
+    async def unsubscribe(self, symbol: str):
+        if self.symbols.pop(symbol, None) is not None:
+            self._send({"type": "unsubscribe", "symbol": symbol})
+
+    def clock_ms(self) -> int:
+        """Feed time behind a replaying broker: the latest trade received."""
+        return self.position
+
+    def _send(self, message: dict):
+        # While disconnected, every symbol is re-subscribed on reconnect
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write((encode_json(message) + "\n").encode())
+
+    async def _run(self):
+        delay = 0.1
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=2 ** 22)
+                self.writer = writer
+                delay = 0.1
+                log.info("broker_feed.connected", path=self.path, symbols=len(self.symbols))
+                for symbol, conn_type in list(self.symbols.items()):
+                    self._send({"type": "subscribe", "symbol": symbol, "conn_type": conn_type})
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    self.frames_received += 1
+                    try:
+                        message = decode_json(line)
+                        symbol = message["s"]
+                        ticks = [Tick(symbol, price, volume, timestamp)
+                                 for price, volume, timestamp in message["data"]]
+                        if ticks:
+                            self.position = max(self.position, ticks[-1].timestamp)
+                        self.on_ticks(symbol, ticks)
+                    except (ValueError, KeyError, TypeError) as e:
+                        log.warning("broker_feed.invalid_message", error=str(e))
+                log.warning("broker_feed.closed", path=self.path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("broker_feed.connect_failed", path=self.path, error=str(e))
+            finally:
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+
+class BarSeries:
+    """OHLCV bars for one symbol at one interval, updated trade by trade.
+
+    Bars are aligned to multiples of the interval. A trade older than the
+    last emitted bar (late prints, clock skew) is counted in the open bar
+    rather than reopening one that clients have already received.
+    """
+
+    __slots__ = ("symbol", "interval", "ms", "start", "open", "high", "low", "close",
+                 "volume", "trades", "closed_until", "history")
+
+    def __init__(self, symbol: str, interval: str):
+        self.symbol = symbol
+        self.interval = interval
+        self.ms = BAR_INTERVALS[interval]
+        self.start: Optional[int] = None  # open bar's start time, None when no bar is open
+        self.open = self.high = self.low = self.close = 0.0
+        self.volume = 0.0
+        self.trades = 0
+        self.closed_until = 0
+        self.history: collections.deque = collections.deque(maxlen=BAR_HISTORY)
+
+    def update(self, price: float, volume: float, timestamp: int) -> Optional[dict]:
+        """Add a trade; returns the previous bar if this trade closed it."""
+        bucket = max(timestamp - timestamp % self.ms, self.closed_until)
+        closed = None
+        if self.start is not None and bucket > self.start:
+            closed = self.finish()
+        if self.start is None:
+            self.start = bucket
+            self.open = self.high = self.low = self.close = price
+            self.volume = volume
+            self.trades = 1
+            return closed
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += volume
+        self.trades += 1
+        return closed
+
+    def finish(self) -> Optional[dict]:
+        """Close the open bar, if any, and return it."""
+        if self.start is None:
+            return None
+        bar = {"s": self.symbol, "i": self.interval, "t": self.start, "o": self.open,
+               "h": self.high, "l": self.low, "c": self.close, "v": self.volume, "n": self.trades}
+        self.history.append(bar)
+        self.closed_until = self.start + self.ms
+        self.start = None
+        return bar
+
+class BarEngine:
+    """Builds 1s/1m/5m bars for every symbol once, whatever the viewer count.
+
+    Bars close either when a trade lands in the next interval or, for quiet
+    symbols, when `clock` (feed time in ms) passes the interval boundary.
+    Closed bars are published on the symbol's bar channel.
+    """
+
+    def __init__(self, publish: Callable[[str, dict], None], clock: Callable[[], int]):
+        self.publish = publish
+        self.clock = clock
+        self.series: Dict[str, List[BarSeries]] = {}  # symbol -> one series per interval
+        self.flushed: Dict[str, int] = {interval: 0 for interval in BAR_INTERVALS}
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def get(self, symbol: str, interval: str) -> Optional[BarSeries]:
+        series = self.series.get(symbol)
+        if series is None:
+            return None
+        return series[list(BAR_INTERVALS).index(interval)]
+
+    def forget(self, symbol: str):
+        self.series.pop(symbol, None)
+
+    def update(self, symbol: str, ticks: List[Tick]):
+        series = self.series.get(symbol)
+        if series is None:
+            series = self.series[symbol] = [BarSeries(symbol, interval) for interval in BAR_INTERVALS]
+        for tick in ticks:
+            for bars in series:
+                closed = bars.update(tick.price, tick.volume, tick.timestamp)
+                if closed is not None:
+                    self._emit(bars, closed)
+
+    def flush(self, now_ms: int):
+        """Close every bar whose interval ended before now_ms."""
+        for position, (interval, ms) in enumerate(BAR_INTERVALS.items()):
+            boundary = now_ms - now_ms % ms
+            if boundary <= self.flushed[interval]:
+                continue
+            self.flushed[interval] = boundary
+            for series in self.series.values():
+                bars = series[position]
+                if bars.start is not None and bars.start + ms <= boundary:
+                    self._emit(bars, bars.finish())
+
+    def _emit(self, bars: BarSeries, bar: dict):
+        self.publish(bar_channel(bars.symbol, bars.interval), {"type": "bar", "data": [bar]})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(0.1)
+            try:
+                self.flush(self.clock())
+            except Exception as e:
+                log.error("bars.flush_failed", error=str(e))
+
+class CoalescedTrades:
+    """Trades for one throttled channel since its last update."""
+
+    __slots__ = ("symbol", "channel", "interval", "price", "volume", "count", "timestamp",
+                 "due", "timer")
+
+    def __init__(self, symbol: str, max_hz: float):
+        self.symbol = symbol
+        self.channel = throttle_channel(symbol, max_hz)
+        self.interval = 1 / max_hz
+        self.price = 0.0
+        self.volume = 0
+        self.count = 0
+        self.timestamp = 0
+        self.due = 0.0  # loop time before which no update may be sent
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, ticks: List[Tick]):
+        for tick in ticks:
+            self.volume += tick.volume
+        last = ticks[-1]
+        self.price = last.price
+        self.timestamp = last.timestamp
+        self.count += len(ticks)
+
+    def take(self) -> dict:
+        update = {"s": self.symbol, "p": self.price, "t": self.timestamp, "v": self.volume,
+                  "n": self.count}
+        self.volume = 0
+        self.count = 0
+        return update
+
+class ThrottleEngine:
+    """Coalesces a symbol's trades into at most max_hz updates per channel.
+
+    Work is per (symbol, rate) channel, not per client: a thousand browsers
+    asking for AAPL at 4 Hz share one accumulator and one encoded frame. The
+    first trade after a quiet spell goes out immediately; trades arriving
+    within the interval after it are merged (last price, summed volume,
+    trade count) and sent when the interval ends.
+    """
+
+    def __init__(self, publish: Callable[[str, dict], None], is_watched: Callable[[str], bool]):
+        self.publish = publish
+        self.is_watched = is_watched
+        self.channels: Dict[str, Dict[str, CoalescedTrades]] = {}  # symbol -> channel -> state
+        self.coalesced = 0  # trades merged into another trade's update
+
+    def add(self, symbol: str, max_hz: float):
+        rates = self.channels.setdefault(symbol, {})
+        # Keyed by channel name: rates that print the same ("4", "4.0000001")
+        # are one channel and must share one accumulator
+        channel = throttle_channel(symbol, max_hz)
+        if channel not in rates:
+            rates[channel] = CoalescedTrades(symbol, max_hz)
+
+    def update(self, symbol: str, ticks: List[Tick]):
+        rates = self.channels.get(symbol)
+        if not rates:
+            return
+        now = asyncio.get_running_loop().time()
+        for state in list(rates.values()):
+            state.add(ticks)
+            if state.timer is not None:
+                continue
+            if now >= state.due:
+                self._emit(state, now)
             else:
-                base_price = random.uniform(100, 200)  # Stock price range
-                
+                state.timer = asyncio.get_running_loop().call_at(state.due, self._flush, state)
+
+    def stop(self):
+        for rates in self.channels.values():
+            for state in rates.values():
+                if state.timer is not None:
+                    state.timer.cancel()
+                    state.timer = None
+
+    def _flush(self, state: CoalescedTrades):
+        state.timer = None
+        if state.count:
+            self._emit(state, asyncio.get_running_loop().time())
+
+    def _emit(self, state: CoalescedTrades, now: float):
+        # Channels nobody watches any more are dropped the next time they fire
+        if not self.is_watched(state.channel):
+            rates = self.channels.get(state.symbol, {})
+            rates.pop(state.channel, None)
+            if not rates:
+                self.channels.pop(state.symbol, None)
+            return
+        self.coalesced += state.count - 1
+        state.due = now + state.interval
+        self.publish(state.channel, {"type": "trade", "data": [state.take()]})
+
+class SymbolAnalytics:
+    """Running analytics for one symbol, each updated in O(1) per trade.
+
+    Session VWAP keeps cumulative price*volume and volume, reset when the
+    UTC day changes. EMAs are per-trade exponential averages. The rolling
+    standard deviation keeps a sum and sum of squares over the trades in the
+    last ANALYTICS_WINDOW_MS, adding the new trade and subtracting the ones
+    that fell out of the window instead of rescanning it. Prices are taken
+    relative to the symbol's first price so the sums stay small.
+    """
+
+    __slots__ = ("session", "pv", "volume", "emas", "window", "shift", "sum", "sum_sq",
+                 "price", "timestamp")
+
+    def __init__(self):
+        self.session = -1
+        self.pv = 0.0
+        self.volume = 0.0
+        self.emas: List[Optional[float]] = [None] * len(ANALYTICS_EMA_PERIODS)
+        self.window: collections.deque = collections.deque()  # (time ms, shifted price)
+        self.shift: Optional[float] = None
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.price = 0.0
+        self.timestamp = 0
+
+    def update(self, price: float, volume: float, timestamp: int):
+        session = timestamp // 86_400_000
+        if session != self.session:
+            self.session = session
+            self.pv = 0.0
+            self.volume = 0.0
+        self.pv += price * volume
+        self.volume += volume
+
+        for i, alpha in enumerate(EMA_ALPHAS):
+            ema = self.emas[i]
+            self.emas[i] = price if ema is None else ema + alpha * (price - ema)
+
+        if self.shift is None:
+            self.shift = price
+        x = price - self.shift
+        self.window.append((timestamp, x))
+        self.sum += x
+        self.sum_sq += x * x
+        cutoff = timestamp - ANALYTICS_WINDOW_MS
+        while self.window and self.window[0][0] <= cutoff:
+            _, old = self.window.popleft()
+            self.sum -= old
+            self.sum_sq -= old * old
+        if not self.window:  # a zero window keeps nothing; drop the rounding residue too
+            self.sum = self.sum_sq = 0.0
+        self.price = price
+        self.timestamp = timestamp
+
+    def stddev(self) -> Optional[float]:
+        n = len(self.window)
+        if n < 2:
+            return None
+        variance = (self.sum_sq - self.sum * self.sum / n) / (n - 1)
+        return max(variance, 0.0) ** 0.5
+
+    def values(self) -> dict:
+        values = {"vwap": self.pv / self.volume if self.volume else None}
+        for period, ema in zip(ANALYTICS_EMA_PERIODS, self.emas):
+            values[f"ema{period}"] = ema
+        values["stddev"] = self.stddev()
+        return values
+
+class AnalyticsEngine:
+    """Keeps SymbolAnalytics for every symbol with trades and streams them.
+
+    Every trade updates its symbol's state exactly once, however many
+    clients watch it. Clients subscribe to an analytics channel with the
+    fields they want ("AAPL@analytics:vwap,ema9"), and each channel gets
+    one update per batch of trades: time, last price and those fields.
+    """
+
+    def __init__(self, publish: Callable[[str, dict], None], is_watched: Callable[[str], bool]):
+        self.publish = publish
+        self.is_watched = is_watched
+        self.state: Dict[str, SymbolAnalytics] = {}
+        self.channels: Dict[str, Dict[str, tuple]] = {}  # symbol -> channel -> fields
+
+    def add(self, symbol: str, fields: tuple):
+        self.channels.setdefault(symbol, {})[analytics_channel(symbol, fields)] = fields
+
+    def forget(self, symbol: str):
+        self.state.pop(symbol, None)
+        self.channels.pop(symbol, None)
+
+    def update(self, symbol: str, ticks: List[Tick]):
+        state = self.state.get(symbol)
+        if state is None:
+            state = self.state[symbol] = SymbolAnalytics()
+        for tick in ticks:
+            state.update(tick.price, tick.volume, tick.timestamp)
+        channels = self.channels.get(symbol)
+        if not channels:
+            return
+        values = state.values()
+        for channel, fields in list(channels.items()):
+            if not self.is_watched(channel):
+                del channels[channel]
+                continue
+            self.publish(channel, {"type": "analytics", "data": [self._select(symbol, state, values, fields)]})
+        if not channels:
+            del self.channels[symbol]
+
+    def snapshot(self, symbol: str, fields: tuple) -> Optional[dict]:
+        state = self.state.get(symbol)
+        if state is None:
+            return None
+        return self._select(symbol, state, state.values(), fields)
+
+    def _select(self, symbol: str, state: SymbolAnalytics, values: dict, fields: tuple) -> dict:
+        update = {"s": symbol, "t": state.timestamp, "p": state.price}
+        for field in fields:
+            update[field] = values[field]
+        return update
+
+def encode_json(message: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(",", ":"))
+
+def decode_json(raw: Union[str, bytes]):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+class JsonEncoder:
+    """Text frames; uses orjson when it is installed."""
+
+    name = "json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        return encode_json(message)
+
+    def join(self, frames: List[str]) -> str:
+        # Frames are already encoded, so batching is a string join
+        return '{"type":"batch","messages":[' + ",".join(frames) + "]}"
+
+class MsgpackEncoder:
+    """MessagePack binary frames (requires the msgpack package)."""
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        return msgpack.packb(message)
+
+    def join(self, frames: List[bytes]) -> bytes:
+        # {"type": "batch", "messages": [...]} around already packed frames
+        n = len(frames)
+        if n < 16:
+            header = bytes([0x90 | n])
+        elif n < 0x10000:
+            header = b"\xdc" + n.to_bytes(2, "big")
+        else:
+            header = b"\xdd" + n.to_bytes(4, "big")
+        return (b"\x82" + msgpack.packb("type") + msgpack.packb("batch")
+                + msgpack.packb("messages") + header + b"".join(frames))
+
+# Fixed-layout binary frames ("binary" encoding), all little-endian. Every
+# frame starts with FRAME_HEADER (kind, count) followed by `count` records:
+#   kind 1 trades    TRADE_RECORD: symbol (16 bytes, NUL padded), price, volume, time ms
+#   kind 2 bars      BAR_RECORD: symbol, interval ms, start ms, open, high, low, close,
+#                    volume, trade count
+#   kind 3 coalesced COALESCED_RECORD: symbol, last price, summed volume, last time ms,
+#                    trade count (max_hz streams)
+#   kind | 0x80      the same records sent as a snapshot
+#   kind 0           any other message: `count` bytes of UTF-8 JSON
+# Batched frames are simply concatenated.
+FRAME_HEADER = struct.Struct("<BI")
+TRADE_RECORD = struct.Struct("<16sddq")
+BAR_RECORD = struct.Struct("<16sIqdddddI")
+COALESCED_RECORD = struct.Struct("<16sddqI")
+KIND_JSON, KIND_TRADE, KIND_BAR, KIND_COALESCED, KIND_SNAPSHOT = 0, 1, 2, 3, 0x80
+
+class StructEncoder:
+    """Compact fixed-layout binary frames for trades, coalesced updates and bars."""
+
+    name = "binary"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        msg_type = message.get("type")
+        data = message.get("data")
+        if msg_type in ("trade", "bar", "snapshot") and data:
+            try:
+                if "i" in data[0]:
+                    kind = KIND_BAR
+                    records = b"".join(BAR_RECORD.pack(
+                        bar["s"].encode(), BAR_INTERVALS[bar["i"]], bar["t"], bar["o"], bar["h"],
+                        bar["l"], bar["c"], bar["v"], bar["n"]) for bar in data)
+                elif "n" in data[0]:
+                    kind = KIND_COALESCED
+                    records = b"".join(COALESCED_RECORD.pack(
+                        update["s"].encode(), update["p"], update["v"], update["t"], update["n"])
+                        for update in data)
+                else:
+                    kind = KIND_TRADE
+                    records = b"".join(TRADE_RECORD.pack(
+                        trade["s"].encode(), trade["p"], trade.get("v") or 0, trade["t"])
+                        for trade in data)
+                if msg_type == "snapshot":
+                    kind |= KIND_SNAPSHOT
+                return FRAME_HEADER.pack(kind, len(data)) + records
+            except (KeyError, TypeError, AttributeError, struct.error):
+                pass  # doesn't fit the fixed layout; send it as JSON
+        payload = encode_json(message).encode()
+        return FRAME_HEADER.pack(KIND_JSON, len(payload)) + payload
+
+    def join(self, frames: List[bytes]) -> bytes:
+        return b"".join(frames)
+
+ENCODERS = {"json": JsonEncoder(), "binary": StructEncoder()}
+if msgpack is not None:
+    ENCODERS["msgpack"] = MsgpackEncoder()
+
+class ClientConnection:
+    """One client websocket with its own bounded outbound queue.
+
+    A writer task drains the queue so a slow client never stalls the feed or
+    other clients. Frames are keyed by symbol: once the queue is full, a new
+    frame for a symbol that is already queued replaces the queued one
+    (merged), otherwise the oldest queued frame is discarded (dropped).
+
+    With a batch window, the writer waits that long after the first queued
+    frame and sends everything collected in one "batch" frame. Frames are
+    already encoded in the connection's wire format (see ENCODERS).
+
+    The timestamps kept here (time.monotonic) let the ConnectionReaper spot
+    clients with no subscriptions and sockets whose send has stopped moving.
+    """
+
+    def __init__(self, conn_id: int, websocket: WebSocket, conn_type: str,
+                 max_queue: int = SEND_QUEUE_SIZE, batch_window: float = 0.0,
+                 encoder: Union[JsonEncoder, MsgpackEncoder, StructEncoder] = ENCODERS["json"],
+                 client_ip: str = "unknown"):
+        self.conn_id = conn_id
+        self.websocket = websocket
+        self.conn_type = conn_type
+        self.encoder = encoder
+        self.client_ip = client_ip
+        self.channels: Dict[str, str] = {}  # channel -> symbol
+        self.idle_since: Optional[float] = time.monotonic()  # set while there are no channels
+        self.sending_since: Optional[float] = None  # set while a send is in progress
+        self.max_queue = max_queue
+        self.batch_window = batch_window
+        self.queue: collections.deque = collections.deque()  # [key, frame] entries
+        self.latest: Dict[str, list] = {}  # key -> newest queued entry
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.merged = 0
+        self.closed = False
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def put(self, frame: Union[str, bytes], key: Optional[str] = None):
+        """Queue a frame without waiting; frames with a key may be conflated."""
+        if self.closed:
+            return
+        if len(self.queue) >= self.max_queue:
+            entry = self.latest.get(key) if key is not None else None
+            if entry is not None:
+                entry[1] = frame
+                self.merged += 1
+                return
+            oldest = self.queue.popleft()
+            if self.latest.get(oldest[0]) is oldest:
+                del self.latest[oldest[0]]
+            self.dropped += 1
+        entry = [key, frame]
+        self.queue.append(entry)
+        if key is not None:
+            self.latest[key] = entry
+        self.wakeup.set()
+
+    async def _write_loop(self):
+        send = self.websocket.send_bytes if self.encoder.binary else self.websocket.send_text
+        try:
             while True:
-                # Check if connection is still active
+                while not self.queue:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                if not self.batch_window:
+                    frame = self._pop()
+                else:
+                    await asyncio.sleep(self.batch_window)
+                    frames = [self._pop() for _ in range(len(self.queue))]
+                    frame = frames[0] if len(frames) == 1 else self.encoder.join(frames)
+                began = time.perf_counter()
+                self.sending_since = time.monotonic()
+                await send(frame)
+                self.sending_since = None
+                metrics.send_latency.observe(time.perf_counter() - began)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("connection.send_failed", conn_id=self.conn_id, conn_type=self.conn_type,
+                        error=repr(e))
+        finally:
+            self.closed = True
+            self.queue.clear()
+            self.latest.clear()
+
+    def _pop(self) -> Union[str, bytes]:
+        entry = self.queue.popleft()
+        if self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+        return entry[1]
+
+    def close(self):
+        self.closed = True
+        self.writer.cancel()
+
+class ConnectionManager:
+    """Tracks client connections by id and which channels each one watches.
+
+    A channel is a symbol's trade stream ("AAPL"), one of its bar streams
+    ("AAPL@1m"), its trades coalesced to a maximum rate ("AAPL@4hz") or its
+    analytics ("AAPL@analytics"); any number of clients may watch the same channel.
+    `broadcast` serializes a payload once per wire format in use and queues
+    the same frame on every subscriber, whose writer tasks then send it
+    concurrently.
+    """
+
+    def __init__(self):
+        self.active_connections: Dict[int, ClientConnection] = {}
+        self.subscriptions: Dict[str, Set[int]] = {}  # channel -> connection ids
+        self.symbol_refs: Dict[str, int] = {}  # symbol -> subscriptions over all its channels
+        self.dropped = 0  # totals from closed connections
+        self.merged = 0
+        self.admitted = 0  # connections accepted or being accepted
+        self.per_ip: Dict[str, int] = {}  # client address -> admitted connections
+        self.rejected: Dict[str, int] = {}  # reason -> connections turned away
+        self.reaped: Dict[str, int] = {}  # reason -> connections closed by the reaper
+        self._ids = itertools.count(1)
+
+    def admit(self, websocket: WebSocket) -> Optional[str]:
+        """Reserve a slot for a new client, or return why it is turned away.
+
+        Runs before the handshake is accepted, so a rejected client costs no
+        writer task, queue or subscription. Call connect() next on success.
+        """
+        client_ip = websocket.client.host if websocket.client else "unknown"
+        if MAX_CONNECTIONS and self.admitted >= MAX_CONNECTIONS:
+            reason = "server_full"
+        elif MAX_CONNECTIONS_PER_IP and self.per_ip.get(client_ip, 0) >= MAX_CONNECTIONS_PER_IP:
+            reason = "ip_limit"
+        else:
+            self.admitted += 1
+            self.per_ip[client_ip] = self.per_ip.get(client_ip, 0) + 1
+            return None
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        log.info("connection.rejected", client_ip=client_ip, reason=reason)
+        return reason
+
+    def _release(self, client_ip: str):
+        self.admitted -= 1
+        self.per_ip[client_ip] -= 1
+        if not self.per_ip[client_ip]:
+            del self.per_ip[client_ip]
+
+    async def connect(self, websocket: WebSocket, conn_type: str = 'stock',
+                      batch_window: float = 0.0, encoding: str = "json") -> int:
+        client_ip = websocket.client.host if websocket.client else "unknown"
+        try:
+            await websocket.accept()
+        except Exception:
+            self._release(client_ip)
+            raise
+        conn_id = next(self._ids)
+        self.active_connections[conn_id] = ClientConnection(conn_id, websocket, conn_type,
+                                                            batch_window=batch_window,
+                                                            encoder=ENCODERS[encoding],
+                                                            client_ip=client_ip)
+        log.info("connection.open", conn_id=conn_id, conn_type=conn_type, encoding=encoding,
+                 client_ip=client_ip)
+        return conn_id
+
+    def subscribe(self, conn_id: int, symbol: str, channel: str) -> bool:
+        """Add a connection to one of a symbol's channels; True if the symbol had
+        no subscribers yet."""
+        subscribers = self.subscriptions.setdefault(channel, set())
+        if conn_id in subscribers:
+            return False
+        subscribers.add(conn_id)
+        connection = self.active_connections[conn_id]
+        connection.channels[channel] = symbol
+        connection.idle_since = None
+        return self.hold(symbol)
+
+    def unsubscribe(self, conn_id: int, symbol: str, channel: str) -> bool:
+        """Remove a connection from one of a symbol's channels; True if the symbol
+        has no subscribers left."""
+        connection = self.active_connections.get(conn_id)
+        if connection is not None:
+            connection.channels.pop(channel, None)
+            if not connection.channels and connection.idle_since is None:
+                connection.idle_since = time.monotonic()
+        subscribers = self.subscriptions.get(channel)
+        if subscribers is None or conn_id not in subscribers:
+            return False
+        subscribers.discard(conn_id)
+        if not subscribers:
+            del self.subscriptions[channel]
+        return self.release(symbol)
+
+    def hold(self, symbol: str) -> bool:
+        """Take a reference on a symbol; True if it had none yet."""
+        self.symbol_refs[symbol] = self.symbol_refs.get(symbol, 0) + 1
+        return self.symbol_refs[symbol] == 1
+
+    def release(self, symbol: str) -> bool:
+        """Drop a reference on a symbol; True if none are left."""
+        self.symbol_refs[symbol] -= 1
+        if self.symbol_refs[symbol] == 0:
+            del self.symbol_refs[symbol]
+            return True
+        return False
+
+    def disconnect(self, conn_id: int) -> List[str]:
+        """Forget a connection; returns the symbols left with no subscribers."""
+        connection = self.active_connections.get(conn_id)
+        if connection is None:
+            return []
+        abandoned = [symbol for channel, symbol in list(connection.channels.items())
+                     if self.unsubscribe(conn_id, symbol, channel)]
+        connection.close()
+        del self.active_connections[conn_id]
+        self._release(connection.client_ip)
+        self.dropped += connection.dropped
+        self.merged += connection.merged
+        log.info("connection.closed", conn_id=conn_id, conn_type=connection.conn_type,
+                 dropped=connection.dropped, merged=connection.merged)
+        return abandoned
+
+    def expired(self, now: float) -> List[tuple]:
+        """(conn_id, reason) for every connection the reaper should close."""
+        expired = []
+        for conn_id, connection in self.active_connections.items():
+            if connection.closed:
+                expired.append((conn_id, "send_failed"))
+            elif connection.sending_since is not None and now - connection.sending_since > SEND_TIMEOUT:
+                expired.append((conn_id, "send_timeout"))
+            elif connection.idle_since is not None and now - connection.idle_since > IDLE_TIMEOUT:
+                expired.append((conn_id, "idle"))
+        return expired
+
+    def send_personal_message(self, message: dict, conn_id: int, key: Optional[str] = None):
+        connection = self.active_connections.get(conn_id)
+        if connection is not None:
+            connection.put(connection.encoder.encode(message), key)
+
+    def broadcast(self, channel: str, payload: dict):
+        subscribers = self.subscriptions.get(channel)
+        if not subscribers:
+            return
+        # Labelled by symbol and kind: channel names are chosen by clients
+        key = (channel_symbol(channel), channel_kind(channel))
+        metrics.outbound[key] = metrics.outbound.get(key, 0) + len(subscribers)
+        # Encoded once per wire format, shared by every subscriber using it
+        frames = {}
+        for conn_id in subscribers:
+            connection = self.active_connections[conn_id]
+            frame = frames.get(connection.encoder)
+            if frame is None:
+                frame = frames[connection.encoder] = connection.encoder.encode(payload)
+            connection.put(frame, channel)
+
+class ConnectionReaper:
+    """Closes client sockets that are dead or idle, so memory and file
+    descriptors stay flat over a long session.
+
+    Peers that stop answering protocol pings are dropped by uvicorn itself
+    (WS_PING_INTERVAL / WS_PING_TIMEOUT). This catches the rest: clients
+    whose writer failed, whose send has been blocked for SEND_TIMEOUT, and
+    clients with no subscription for IDLE_TIMEOUT.
+    """
+
+    def __init__(self, manager: "ConnectionManager", interval: float = 1.0):
+        self.manager = manager
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def reap(self, conn_id: int, reason: str):
+        connection = self.manager.active_connections.get(conn_id)
+        if connection is None:
+            return
+        self.manager.reaped[reason] = self.manager.reaped.get(reason, 0) + 1
+        log.info("connection.reaped", conn_id=conn_id, conn_type=connection.conn_type,
+                 client_ip=connection.client_ip, reason=reason)
+        # Release its subscriptions first; the close handshake may never complete
+        await close_connection(conn_id)
+        try:
+            await asyncio.wait_for(connection.websocket.close(code=1001 if reason == "idle" else 1011,
+                                                              reason=reason), timeout=1.0)
+        except Exception:
+            pass  # already gone, or the peer is not reading
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for conn_id, reason in self.manager.expired(time.monotonic()):
                 try:
-                    # Simplified connection check - let the WebSocket error handling catch any issues
-                    await websocket.send_json({"type": "ping"})
-                    
-                    # Generate new price data
-                    price_change = random.uniform(-5, 5)
-                    base_price = max(0.01, base_price + price_change)  # Ensure price doesn't go below 0.01
-                    
-                    # Format the response based on connection type
-                    if conn_type == 'crypto':
-                        response = {
-                            "type": "trade",
-                            "data": [{
-                                "s": symbol,
-                                "p": round(base_price, 2),
-                                "t": int(time.time() * 1000),
-                                "v": random.uniform(0.1, 10)
-                            }]
-                        }
-                    else:  # stock
-                        response = {
-                            "type": "trade",
-                            "data": [{
-                                "s": symbol,
-                                "p": round(base_price, 2),
-                                "t": int(time.time() * 1000),
-                                "v": random.randint(100, 10000)
-                            }]
-                        }
-                    
-                    await websocket.send_json(response)
-                    await asyncio.sleep(1)  # Update every second
-                    
-                except WebSocketDisconnect:
-                    print("Client disconnected")
-                    break
+                    await self.reap(conn_id, reason)
                 except Exception as e:
-                    print(f"Error in demo mode: {e}")
-                    break
-                    
-        except Exception as e:
-            print(f"Error in demo mode: {e}")
-            await websocket.send_json({"error": f"Demo mode error: {str(e)}"})
-    else:
-        print(f"Connecting to Finnhub WebSocket for {symbol}")
+                    log.error("connection.reap_failed", conn_id=conn_id, error=str(e))
+
+def feed_clock_ms() -> int:
+    """Feed time in ms: how far a replay has got, otherwise the wall clock."""
+    if REPLAY_PATH:
+        return market_feed.clock_ms()
+    return int(time.time() * 1000)
+
+manager = ConnectionManager()
+reaper = ConnectionReaper(manager)
+tick_history: Dict[str, TickRing] = {}
+quote_cache = QuoteCache()
+bar_engine = BarEngine(manager.broadcast, feed_clock_ms)
+throttle = ThrottleEngine(manager.broadcast, manager.subscriptions.__contains__)
+analytics_engine = AnalyticsEngine(manager.broadcast, manager.subscriptions.__contains__)
+# Workers behind a feed broker leave recording to the broker
+recorder = TickRecorder(RECORD_DIR) if RECORD_DIR and not (FEED_SOCKET or REPLAY_PATH) else None
+
+def publish_ticks(symbol: str, ticks: List[Tick]):
+    """Single entry point for new trades from any feed: record, then fan out.
+
+    Feeds have already parsed, validated and deduplicated the ticks, so
+    nothing here looks at the upstream wire format.
+    """
+    metrics.inbound[symbol] = metrics.inbound.get(symbol, 0) + len(ticks)
+    # Trades still in flight after the last unsubscribe would only bring
+    # back the state dropped with it
+    if symbol not in manager.symbol_refs:
+        return
+    if recorder is not None:
+        recorder.record(symbol, ticks)
+    ring = tick_history.get(symbol)
+    if ring is None:
+        ring = tick_history[symbol] = TickRing()
+    for tick in ticks:
+        ring.append(tick.price, tick.volume, tick.timestamp)
+    quote_cache.update(symbol, ticks[-1])
+    bar_engine.update(symbol, ticks)
+    throttle.update(symbol, ticks)
+    analytics_engine.update(symbol, ticks)
+    manager.broadcast(symbol, {"type": "trade", "data": [tick.to_dict() for tick in ticks]})
+
+if FEED_SOCKET:
+    market_feed = BrokerFeed(FEED_SOCKET, publish_ticks)
+else:
+    market_feed = create_upstream_feed(publish_ticks, manager.symbol_refs.__contains__)
+
+# WebSocket endpoint for market data (stocks and crypto). With ?bars=1s|1m|5m
+# the client receives closed OHLCV bars instead of every trade; with
+# ?max_hz=4 at most 4 updates a second, each merging the trades since the
+# last one ({"s", "p": last price, "v": summed volume, "n": trade count, "t"});
+# with ?analytics=vwap,ema9 (or "all") a {"type": "analytics"} update with
+# those fields after every trade; ?encoding=json|msgpack|binary selects the
+# wire format.
+@app.websocket("/ws/{symbol}")
+async def websocket_endpoint(websocket: WebSocket, symbol: str, is_crypto: bool = False,
+                             bars: Optional[str] = None, max_hz: Optional[float] = None,
+                             analytics: Optional[str] = None, encoding: str = "json"):
+    symbol = symbol.upper()
+    conn_type = 'crypto' if is_crypto or symbol == 'BTC' else 'stock'
+    try:
+        fields = analytics_fields(analytics)
+        error = stream_error(bars, max_hz, fields)
+    except ValueError as e:
+        error = str(e)
+    if not valid_symbol(symbol):
+        error = f"Invalid symbol: {symbol[:32]}"
+    if error is not None:
+        log.info("connection.rejected", symbol=symbol, conn_type=conn_type, reason=error)
+        await websocket.close(code=1008, reason=error)
+        return
+    if encoding not in ENCODERS:
+        await websocket.close(code=1008, reason=f"Unsupported encoding: {encoding}")
+        return
+    if manager.admit(websocket) is not None:
+        await websocket.close(code=1013)
+        return
+
+    conn_id = await manager.connect(websocket, conn_type, encoding=encoding)
+    log.info("connection.accepted", conn_id=conn_id, conn_type=conn_type, symbol=symbol,
+             demo=DEMO_MODE)
+
+    try:
+        await subscribe_symbol(conn_id, symbol, conn_type, bars, max_hz, fields)
+        # Ticks are pushed by the shared feed; the subscription is fixed by
+        # the URL, so anything but a ping from the client is an error
+        async for message in client_messages(conn_id, websocket):
+            manager.send_personal_message(
+                {"error": "Subscriptions can't be changed on /ws/{symbol}; use /ws"}, conn_id)
+    except WebSocketDisconnect:
+        log.info("connection.disconnected", conn_id=conn_id, conn_type=conn_type, symbol=symbol)
+    finally:
+        await close_connection(conn_id)
+
+# Multiplexed WebSocket endpoint: any number of symbols over one socket.
+# Clients send {"type": "subscribe", "symbols": ["AAPL", "MSFT"]} (or
+# "symbol": "AAPL", with optional "is_crypto", "bars": "1m", "max_hz": 4 or
+# "analytics": ["vwap", "ema9"]) and the
+# matching {"type": "unsubscribe", ...}; {"type": "ping"} is answered with
+# {"type": "pong"}. Ticks arriving within batch_ms of each other
+# are delivered together as {"type": "batch", "messages": [...]} (or, for
+# the binary encoding, as concatenated frames).
+@app.websocket("/ws")
+async def multiplexed_endpoint(websocket: WebSocket, batch_ms: float = BATCH_WINDOW_MS,
+                               encoding: str = "json"):
+    if encoding not in ENCODERS:
+        await websocket.close(code=1008, reason=f"Unsupported encoding: {encoding}")
+        return
+    if manager.admit(websocket) is not None:
+        await websocket.close(code=1013)
+        return
+    batch_window = min(max(batch_ms, 0), 1000) / 1000
+    conn_id = await manager.connect(websocket, 'multi', batch_window=batch_window,
+                                    encoding=encoding)
+    try:
+        async for message in client_messages(conn_id, websocket):
+            await handle_subscription_request(conn_id, message)
+    except WebSocketDisconnect:
+        log.info("connection.disconnected", conn_id=conn_id, conn_type='multi')
+    finally:
+        await close_connection(conn_id)
+
+async def client_messages(conn_id: int, websocket: WebSocket):
+    """Reader for one client socket: drains every frame as soon as it arrives.
+
+    Answers {"type": "ping"} with {"type": "pong"}, ignores pongs, reports
+    frames that aren't JSON objects and yields everything else. Raises
+    WebSocketDisconnect when the client goes away, and stops once the
+    connection has been reaped.
+    """
+    while True:
+        frame = await websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        if conn_id not in manager.active_connections:
+            return
+        raw = frame.get("text")
+        if raw is None:
+            raw = frame.get("bytes") or b""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.ws_connect(FINNHUB_WS_URL) as feed:
-                    await feed.send_json({"type": "subscribe", "symbol": symbol})
-                    
-                    while True:
-                        try:
-                            msg = await feed.receive()
-                            
-                            if msg.type == aiohttp.WSMsgType.TEXT:
-                                await websocket.send_text(msg.data)
-                            elif msg.type == aiohttp.WSMsgType.ERROR:
-                                error = feed.exception()
-                                print(f"Finnhub WebSocket error: {error}")
-                                await websocket.send_json({"error": str(error)})
-                                break
-                            elif msg.type == aiohttp.WSMsgType.CLOSED:
-                                print("Finnhub WebSocket connection closed")
-                                break
-                                
-                        except WebSocketDisconnect:
-                            print(f"Client {symbol} disconnected")
-                            break
-                            
-                        except Exception as e:
-                            print(f"Error in Finnhub WebSocket for {symbol}: {str(e)}")
-                            try:
-                                # Try to send the error message, but don't check the state
-                                await websocket.send_json({"error": str(e)})
-                            except Exception as send_error:
-                                print(f"Error sending error message: {send_error}")
-                            break
-                            
-        except Exception as e:
-            print(f"Failed to connect to Finnhub WebSocket: {str(e)}")
-            await websocket.send_json({"error": f"Failed to connect to market data: {str(e)}"})
-    
-    # Clean up
-    manager.disconnect(symbol)
+            message = decode_json(raw)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            manager.send_personal_message({"error": "Invalid message"}, conn_id)
+            continue
+        msg_type = message.get("type")
+        if msg_type == "ping":
+            manager.send_personal_message({"type": "pong"}, conn_id)
+        elif msg_type != "pong":
+            yield message
+
+async def handle_subscription_request(conn_id: int, message: dict):
+    connection = manager.active_connections.get(conn_id)
+    if connection is None:
+        return
+    symbols = message.get("symbols") or message.get("symbol") or []
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    if not isinstance(symbols, list) or not all(isinstance(symbol, str) for symbol in symbols):
+        manager.send_personal_message({"error": "symbols must be a list of strings"}, conn_id)
+        return
+    symbols = [symbol.upper() for symbol in symbols if symbol]
+    invalid = [symbol for symbol in symbols if not valid_symbol(symbol)]
+    if invalid:
+        manager.send_personal_message(
+            {"error": f"Invalid symbols: {', '.join(symbol[:32] for symbol in invalid[:10])}"}, conn_id)
+        return
+    try:
+        msg_type = message.get("type")
+        bars = message.get("bars")
+        max_hz = message.get("max_hz")
+        max_hz = float(max_hz) if max_hz is not None else None
+    except (ValueError, AttributeError, TypeError):
+        manager.send_personal_message({"error": "Invalid message"}, conn_id)
+        return
     try:
-        data = await websocket.receive_text()
-        print(f"Received message: {data}")
-    except WebSocketDisconnect as e:
-        print(f"WebSocket close: {e}")
+        fields = analytics_fields(message.get("analytics"))
+        error = stream_error(bars, max_hz, fields)
+    except ValueError as e:
+        error = str(e)
+    if error is not None:
+        manager.send_personal_message({"error": error}, conn_id)
+        return
+
+    if msg_type == "subscribe":
+        channels = {stream_channel(symbol, bars, max_hz, fields) for symbol in symbols}
+        if len(connection.channels.keys() | channels) > MAX_SYMBOLS_PER_CONNECTION:
+            manager.send_personal_message(
+                {"error": f"At most {MAX_SYMBOLS_PER_CONNECTION} symbols per connection"}, conn_id)
+            return
+        for symbol in symbols:
+            conn_type = 'crypto' if message.get("is_crypto") or symbol == 'BTC' else 'stock'
+            await subscribe_symbol(conn_id, symbol, conn_type, bars, max_hz, fields)
+    elif msg_type == "unsubscribe":
+        for symbol in symbols:
+            await unsubscribe_symbol(conn_id, symbol, bars, max_hz, fields)
+    else:
+        manager.send_personal_message({"error": f"Unknown message type: {msg_type}"}, conn_id)
+        return
+    manager.send_personal_message(
+        {"type": "subscriptions", "channels": sorted(connection.channels)}, conn_id)
+
+async def subscribe_symbol(conn_id: int, symbol: str, conn_type: str = 'stock',
+                           bars: Optional[str] = None, max_hz: Optional[float] = None,
+                           fields: Optional[tuple] = None):
+    channel = stream_channel(symbol, bars, max_hz, fields)
+    connection = manager.active_connections.get(conn_id)
+    if connection is None or channel in connection.channels:
+        return
+    # Queue the recent history first so the client has something to show
+    # before the next trade (or bar) arrives
+    if fields:
+        current = analytics_engine.snapshot(symbol, fields)
+        if current is not None:
+            manager.send_personal_message({"type": "analytics", "data": [current]}, conn_id)
+        recent = []
+    elif bars:
+        series = bar_engine.get(symbol, bars)
+        recent = list(series.history)[-SNAPSHOT_SIZE:] if series is not None else []
+    else:
+        ring = tick_history.get(symbol)
+        recent = ring.to_trades(symbol, SNAPSHOT_SIZE) if ring is not None else []
+    if recent:
+        manager.send_personal_message({"type": "snapshot", "data": recent}, conn_id)
+    if max_hz:
+        throttle.add(symbol, max_hz)
+    if fields:
+        analytics_engine.add(symbol, fields)
+    if manager.subscribe(conn_id, symbol, channel):
+        await market_feed.subscribe(symbol, conn_type)
+
+async def unsubscribe_symbol(conn_id: int, symbol: str, bars: Optional[str] = None,
+                             max_hz: Optional[float] = None, fields: Optional[tuple] = None):
+    if manager.unsubscribe(conn_id, symbol, stream_channel(symbol, bars, max_hz, fields)):
+        await abandon_symbol(symbol)
+
+async def close_connection(conn_id: int):
+    for abandoned in manager.disconnect(conn_id):
+        await abandon_symbol(abandoned)
+
+async def hold_symbol(symbol: str, conn_type: str = 'stock'):
+    """Keep a symbol subscribed upstream without a client channel (a /quotes lease)."""
+    if manager.hold(symbol):
+        await market_feed.subscribe(symbol, conn_type)
+
+async def release_symbol(symbol: str):
+    if manager.release(symbol):
+        await abandon_symbol(symbol)
+
+async def abandon_symbol(symbol: str):
+    """The last reference on a symbol is gone: unsubscribe upstream and drop
+    everything kept for it, so memory follows what is watched now."""
+    tick_history.pop(symbol, None)
+    quote_cache.forget(symbol)
+    bar_engine.forget(symbol)
+    analytics_engine.forget(symbol)
+    await market_feed.unsubscribe(symbol)
+
+# Recent trades for a watched symbol from the in-memory history
+@app.get("/history/{symbol}")
+async def get_history(symbol: str, limit: int = 100):
+    symbol = symbol.upper()
+    ring = tick_history.get(symbol)
+    if ring is None:
+        raise HTTPException(status_code=404, detail=f"No trades recorded for {symbol}")
+    return {"symbol": symbol, "data": ring.to_trades(symbol, min(max(limit, 0), HISTORY_SIZE))}
+
+# Last trade for many symbols at once, e.g. /quotes?symbols=AAPL,MSFT
+# (&is_crypto=true for crypto symbols). Polled symbols stay subscribed
+# upstream until QUOTE_SUBSCRIPTION_TTL passes without a poll; symbols the
+# server has no trades for yet are listed under "missing". Send the returned
+# ETag back as If-None-Match to get a bodiless 304 until one of the quotes
+# changes.
+@app.get("/quotes")
+async def get_quotes(request: Request, symbols: str, is_crypto: bool = False):
+    wanted = list(dict.fromkeys(symbol.strip().upper() for symbol in symbols.split(",")
+                                if symbol.strip()))
+    if not wanted:
+        raise HTTPException(status_code=400, detail="No symbols requested")
+    if len(wanted) > MAX_QUOTE_SYMBOLS:
+        raise HTTPException(status_code=400,
+                            detail=f"At most {MAX_QUOTE_SYMBOLS} symbols per request")
+    invalid = [symbol for symbol in wanted if not valid_symbol(symbol)]
+    if invalid:
+        raise HTTPException(status_code=400,
+                            detail=f"Invalid symbols: {', '.join(symbol[:32] for symbol in invalid[:10])}")
+    leased = quote_cache.lease(wanted)
+    if leased is None:
+        raise HTTPException(status_code=503, detail="Too many symbols are being polled; try again later")
+    for symbol in leased:
+        await hold_symbol(symbol, 'crypto' if is_crypto or symbol == 'BTC' else 'stock')
+    etag = quote_cache.etag(wanted)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in
+                          (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))):
+        return Response(status_code=304, headers=headers)
+    # Serialized directly; skips FastAPI's response model encoding
+    return Response(encode_json(quote_cache.quotes(wanted)), media_type="application/json",
+                    headers=headers)
+
+# Prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Serve the main HTML file
 @app.get("/", response_class=HTMLResponse)
@@ -304,7 +2639,7 @@ async def read_index():
                 const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
                 // Use localhost explicitly to avoid any hostname resolution issues
                 const endpoint = isCrypto || currentSymbol === 'BTC' ? 'crypto' : 'stock';
-                const wsUrl = `${wsProtocol}//${window.location.hostname}:8003/ws/${currentSymbol}?is_crypto=${isCrypto}`;
+                const wsUrl = `${wsProtocol}//${window.location.hostname}:8003/ws/${currentSymbol}?is_crypto=${isCrypto}&max_hz=4`;
                 console.log('WebSocket URL:', wsUrl);
                 
                 try {
@@ -340,9 +2675,9 @@ async def read_index():
                                 return;
                             }
                             
-                            // Process stock data
+                            // Process stock data (trades and snapshots; newest last)
                             if (data.data && data.data.length > 0) {
-                                const stock = data.data[0];
+                                const stock = data.data[data.data.length - 1];
                                 const price = parseFloat(stock.p).toFixed(2);
                                 const volume = parseInt(stock.v).toLocaleString();
                                 const timestamp = new Date(stock.t).toLocaleTimeString();
@@ -455,5 +2790,32 @@ async def read_index():
 
 # Start the server
 if __name__ == "__main__":
+    import argparse
+    import subprocess
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8003)
+
+    parser = argparse.ArgumentParser(description="Stock price tracker server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8003)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="uvicorn worker processes; with more than one, a separate feed "
+                             "broker process owns the upstream connection")
+    parser.add_argument("--broker", action="store_true",
+                        help="only run the feed broker on FEED_SOCKET")
+    args = parser.parse_args()
+
+    if args.broker:
+        asyncio.run(FeedBroker(FEED_SOCKET or DEFAULT_FEED_SOCKET).serve())
+    elif args.workers > 1:
+        os.environ["FEED_SOCKET"] = FEED_SOCKET or DEFAULT_FEED_SOCKET
+        broker = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--broker"])
+        try:
+            uvicorn.run("app22:app", host=args.host, port=args.port, workers=args.workers,
+                        app_dir=os.path.dirname(os.path.abspath(__file__)),
+                        ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
+        finally:
+            broker.terminate()
+            broker.wait()
+    else:
+        uvicorn.run(app, host=args.host, port=args.port,
+                    ws_ping_interval=WS_PING_INTERVAL, ws_ping_timeout=WS_PING_TIMEOUT)
@@ -0,0 +1,391 @@
+"""Fan-out load test and latency benchmark for app22.py.
+
+Starts a local stand-in for the Finnhub WebSocket that publishes trades at a
+configurable rate across many symbols, runs app22.py against it, drives
+simulated browser clients and prints a JSON report:
+
+    python bench.py --clients 2000 --symbols 200 --rate 5000 --duration 20
+    python bench.py --output new.json --baseline old.json
+
+Latency is measured from the moment the fake upstream sends a trade to the
+moment a client receives it. The fake server sends each frame on a whole
+millisecond and stamps its trades with that millisecond, so Finnhub's
+integer `t` field is enough to measure sub-millisecond latencies.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app22.py")
+
+# Latencies are kept in a log-scale histogram (16 buckets per doubling,
+# about 4% resolution) so millions of samples cost a few KB per process
+BUCKETS_PER_OCTAVE = 16
+MAX_BUCKET = 40 * BUCKETS_PER_OCTAVE
+
+def bucket_of(latency_us: float) -> int:
+    return min(int(math.log2(max(latency_us, 0) + 1) * BUCKETS_PER_OCTAVE), MAX_BUCKET)
+
+def bucket_value(bucket: int) -> float:
+    return 2 ** (bucket / BUCKETS_PER_OCTAVE) - 1
+
+def percentiles(histogram: List[int], quantiles: List[float]) -> List[Optional[float]]:
+    """Latency in ms at each quantile of a bucket_of() histogram."""
+    total = sum(histogram)
+    if not total:
+        return [None] * len(quantiles)
+    results = []
+    for q in quantiles:
+        target = q * total
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                results.append(round(bucket_value(bucket) / 1000, 3))
+                break
+    return results
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def process_rss_kb(pid: int) -> int:
+    """Resident memory of a process and all its descendants (Linux only)."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+class FakeFinnhub:
+    """Stand-in for wss://ws.finnhub.io that publishes synthetic trades.
+
+    Like Finnhub, it only sends trades for subscribed symbols and batches
+    trades for several symbols into one frame. `rate` is the total number of
+    trades per second, spread evenly over the subscribed symbols.
+    """
+
+    def __init__(self, rate: float, frame_ms: int):
+        self.rate = rate
+        self.frame_ms = frame_ms
+        self.subscribed: Dict[str, float] = {}  # symbol -> last price
+        self.sockets = set()
+        self.trades_sent = 0
+        self.frames_sent = 0
+        self.subscribe_messages = 0
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                message = json.loads(msg.data)
+                symbol = message.get("symbol")
+                if message.get("type") == "subscribe":
+                    self.subscribe_messages += 1
+                    self.subscribed.setdefault(symbol, random.uniform(100, 200))
+                elif message.get("type") == "unsubscribe":
+                    self.subscribed.pop(symbol, None)
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def publish(self):
+        carry = 0.0
+        next_ms = int(time.time() * 1000) + self.frame_ms
+        while True:
+            # Sleep until the frame's millisecond so `t` is the true send time
+            await asyncio.sleep(max(0.0, next_ms / 1000 - time.time()))
+            stamp = next_ms
+            next_ms += self.frame_ms
+            if int(time.time() * 1000) > next_ms:
+                next_ms = int(time.time() * 1000) + self.frame_ms  # fell behind
+            symbols = list(self.subscribed)
+            if not symbols or not self.sockets:
+                continue
+            carry += self.rate * self.frame_ms / 1000
+            count = int(carry)
+            carry -= count
+            if not count:
+                continue
+            trades = []
+            for i in range(count):
+                symbol = symbols[i % len(symbols)]
+                price = max(0.01, self.subscribed[symbol] + random.uniform(-0.5, 0.5))
+                self.subscribed[symbol] = price
+                trades.append({"s": symbol, "p": round(price, 2), "t": stamp,
+                               "v": random.randint(1, 500), "c": None})
+            frame = json.dumps({"type": "trade", "data": trades})
+            for ws in list(self.sockets):
+                await ws.send_str(frame)
+            self.trades_sent += count
+            self.frames_sent += 1
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.router.add_get("/", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        self.task = asyncio.create_task(self.publish())
+        return runner
+
+def count_trades(message: dict, receive_ms: float, stats: dict):
+    msg_type = message.get("type")
+    if msg_type == "batch":
+        for inner in message.get("messages", ()):
+            count_trades(inner, receive_ms, stats)
+    elif msg_type == "trade":
+        histogram = stats["histogram"]
+        for trade in message.get("data", ()):
+            histogram[bucket_of((receive_ms - trade["t"]) * 1000)] += 1
+            stats["ticks"] += 1
+
+async def run_client(url: str, subscribe: Optional[dict], stats: dict, start_at: float, end_at: float):
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url, max_msg_size=0) as ws:
+                stats["connected"] += 1
+                if subscribe is not None:
+                    await ws.send_str(json.dumps(subscribe))
+                while True:
+                    msg = await ws.receive(timeout=max(0.1, end_at - time.time()))
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    now = time.time()
+                    if now >= end_at:
+                        break
+                    if now < start_at:
+                        continue
+                    stats["frames"] += 1
+                    count_trades(json.loads(msg.data), now * 1000, stats)
+    except asyncio.TimeoutError:
+        pass
+    except Exception as e:
+        stats["errors"] += 1
+        if stats["errors"] <= 3:
+            print(f"Client error: {e}", file=sys.stderr)
+
+async def run_clients(base_url: str, client_ids: List[int], symbols: List[str], per_client: int,
+                      connect_rate: float, start_at: float, end_at: float) -> dict:
+    stats = {"connected": 0, "errors": 0, "frames": 0, "ticks": 0,
+             "histogram": [0] * (MAX_BUCKET + 1)}
+    tasks = []
+    for client_id in client_ids:
+        if per_client > 1:
+            chosen = [symbols[(client_id * per_client + i) % len(symbols)] for i in range(per_client)]
+            url, subscribe = f"{base_url}/ws", {"type": "subscribe", "symbols": chosen}
+        else:
+            url, subscribe = f"{base_url}/ws/{symbols[client_id % len(symbols)]}", None
+        tasks.append(asyncio.create_task(run_client(url, subscribe, stats, start_at, end_at)))
+        await asyncio.sleep(1 / connect_rate)
+    await asyncio.gather(*tasks)
+    return stats
+
+def client_process(args) -> dict:
+    return asyncio.run(run_clients(*args))
+
+async def probe_http(base_url: str, start_at: float, end_at: float) -> List[float]:
+    """HTTP round trips to the app during the run, as clients would see them."""
+    samples = []
+    async with aiohttp.ClientSession() as session:
+        while time.time() < end_at:
+            began = time.perf_counter()
+            try:
+                async with session.get(f"{base_url}/history/__probe__") as response:
+                    await response.read()
+            except aiohttp.ClientError:
+                pass
+            if time.time() >= start_at:
+                samples.append((time.perf_counter() - began) * 1000)
+            await asyncio.sleep(0.1)
+    return samples
+
+async def scrape_loop_lag(base_url: str) -> Dict[str, float]:
+    """Cumulative event-loop lag histogram buckets from the app's /metrics."""
+    buckets = {}
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{base_url}/metrics") as response:
+                text = await response.text()
+    except aiohttp.ClientError:
+        return buckets
+    for line in text.splitlines():
+        if line.startswith("tracker_event_loop_lag_seconds_bucket"):
+            bound = line.split('le="', 1)[1].split('"', 1)[0]
+            buckets[bound] = float(line.rsplit(" ", 1)[1])
+    return buckets
+
+def loop_lag_quantiles(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, Optional[float]]:
+    """Upper bucket bound, in ms, of the loop lag quantiles between two scrapes."""
+    deltas = [(bound, after[bound] - before.get(bound, 0.0)) for bound in after]
+    total = deltas[-1][1] if deltas else 0
+    result = {}
+    for name, q in (("p50", 0.5), ("p99", 0.99)):
+        result[name] = None
+        for bound, cumulative in deltas:
+            if total and cumulative >= q * total:
+                result[name] = None if bound == "+Inf" else float(bound) * 1000
+                break
+    return result
+
+async def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"app did not start listening on port {port}")
+
+async def benchmark(args) -> dict:
+    upstream_port, app_port = free_port(), free_port()
+    fake = FakeFinnhub(args.rate, args.frame_ms)
+    runner = await fake.start(upstream_port)
+
+    # Every simulated client comes from 127.0.0.1, so lift the per-address limit
+    env = dict(os.environ, IEX_KEY="bench", FINNHUB_WS_URL=f"ws://127.0.0.1:{upstream_port}/",
+               FEED_SOCKET=f"/tmp/app22-bench-{app_port}.sock", MAX_CONNECTIONS_PER_IP="0")
+    if args.workers <= 1:
+        env.pop("FEED_SOCKET")
+    server = subprocess.Popen([sys.executable, APP_PATH, "--host", "127.0.0.1", "--port", str(app_port),
+                               "--workers", str(args.workers)],
+                              env=env, stdout=subprocess.DEVNULL if args.quiet else None,
+                              stderr=subprocess.DEVNULL if args.quiet else None)
+    try:
+        await wait_for_port(app_port)
+        base_url = f"ws://127.0.0.1:{app_port}"
+        symbols = [f"SYM{i:04d}" for i in range(args.symbols)]
+        rss_before = process_rss_kb(server.pid)
+
+        connect_time = args.clients / args.connect_rate
+        start_at = time.time() + connect_time + args.warmup
+        end_at = start_at + args.duration
+        procs = max(1, min(args.client_procs, args.clients))
+        chunks = [list(range(args.clients))[i::procs] for i in range(procs)]
+        jobs = [(base_url, chunk, symbols, args.symbols_per_client, args.connect_rate / procs,
+                 start_at, end_at) for chunk in chunks]
+
+        loop = asyncio.get_running_loop()
+        with multiprocessing.get_context("spawn").Pool(procs) as pool:
+            clients = loop.run_in_executor(None, pool.map, client_process, jobs)
+            probe = asyncio.create_task(probe_http(f"http://127.0.0.1:{app_port}", start_at, end_at))
+            await asyncio.sleep(max(0.0, start_at - time.time()))
+            sent_at_start = fake.trades_sent
+            lag_before = await scrape_loop_lag(f"http://127.0.0.1:{app_port}")
+            await asyncio.sleep(max(0.0, end_at - time.time()))
+            sent_in_window = fake.trades_sent - sent_at_start
+            lag_after = await scrape_loop_lag(f"http://127.0.0.1:{app_port}")
+            rss_after = process_rss_kb(server.pid)
+            results = await clients
+            probe_samples = await probe
+    finally:
+        server.terminate()
+        server.wait()
+        fake.task.cancel()
+        await runner.cleanup()
+
+    histogram = [sum(counts) for counts in zip(*(r["histogram"] for r in results))]
+    connected = sum(r["connected"] for r in results)
+    ticks = sum(r["ticks"] for r in results)
+    p50, p99, p999, p100 = percentiles(histogram, [0.5, 0.99, 0.999, 1.0])
+    probe_samples.sort()
+    return {
+        "config": vars(args),
+        "clients_connected": connected,
+        "client_errors": sum(r["errors"] for r in results),
+        "ticks_received": ticks,
+        "ticks_per_sec": round(ticks / args.duration, 1),
+        "frames_per_sec": round(sum(r["frames"] for r in results) / args.duration, 1),
+        "upstream_trades_per_sec": round(sent_in_window / args.duration, 1),
+        "upstream_subscribe_messages": fake.subscribe_messages,
+        "latency_ms": {"p50": p50, "p99": p99, "p999": p999, "max": p100},
+        "server_rss_kb": {"before": rss_before, "after": rss_after},
+        "memory_per_connection_kb": round((rss_after - rss_before) / connected, 2) if connected else None,
+        # From one worker's /metrics when --workers > 1
+        "event_loop_lag_ms": loop_lag_quantiles(lag_before, lag_after),
+        "http_probe_ms": {
+            "p50": round(probe_samples[len(probe_samples) // 2], 3) if probe_samples else None,
+            "p99": round(probe_samples[int(len(probe_samples) * 0.99)], 3) if probe_samples else None,
+            "max": round(probe_samples[-1], 3) if probe_samples else None,
+        },
+    }
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of `report` against `baseline` beyond the relative tolerance."""
+    regressions = []
+    if report["ticks_per_sec"] < baseline["ticks_per_sec"] * (1 - tolerance):
+        regressions.append(f"ticks_per_sec {report['ticks_per_sec']} < {baseline['ticks_per_sec']}")
+    for key in ("p50", "p99", "p999"):
+        new, old = report["latency_ms"][key], baseline["latency_ms"][key]
+        if new is not None and old is not None and new > old * (1 + tolerance):
+            regressions.append(f"latency {key} {new}ms > {old}ms")
+    new, old = report["memory_per_connection_kb"], baseline["memory_per_connection_kb"]
+    if new is not None and old is not None and new > old * (1 + tolerance):
+        regressions.append(f"memory_per_connection_kb {new} > {old}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test app22.py against a fake Finnhub feed")
+    parser.add_argument("--clients", type=int, default=1000, help="simulated browser clients")
+    parser.add_argument("--symbols", type=int, default=100, help="distinct symbols")
+    parser.add_argument("--symbols-per-client", type=int, default=1,
+                        help="more than one uses the multiplexed /ws endpoint")
+    parser.add_argument("--rate", type=float, default=1000, help="upstream trades per second, all symbols")
+    parser.add_argument("--frame-ms", type=int, default=10, help="upstream frame interval")
+    parser.add_argument("--duration", type=float, default=10, help="measurement window in seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds between connecting and measuring")
+    parser.add_argument("--connect-rate", type=float, default=500, help="new client connections per second")
+    parser.add_argument("--client-procs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="processes used to drive the clients")
+    parser.add_argument("--workers", type=int, default=1, help="app22.py worker processes")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="earlier report; exit 1 on regressions beyond --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--quiet", action="store_true", help="hide the app's own output")
+    args = parser.parse_args()
+
+    report = asyncio.run(benchmark(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()